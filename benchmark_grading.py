@@ -0,0 +1,456 @@
+import os
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw
+
+# Benchmark harness for grade_homework.py: generates a fake Blackboard gradebook, serves a local stub
+# of the Messages API, runs main() against it and reports throughput, peak memory and per-stage time.
+#
+# Example:
+#   python benchmark_grading.py --students 100 --pages 6 --latency 3 --rate-429 0.05 --workers 8
+#   python benchmark_grading.py --students 100 -- --batch     (arguments after "--" go to grade_homework.main)
+#   python benchmark_grading.py --students 100 --processes 3 -- --worker
+#   python benchmark_grading.py -- --assignments spec.json     (run reports are read from each assignment's output_dir)
+
+def draw_page(width, height, rng, background=(255, 255, 255), ink_lines=40):
+    """Draw a page of fake handwriting: random pen strokes on a plain background"""
+    page = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(page)
+    line_height = height // (ink_lines + 4)
+    for line in range(ink_lines):
+        y = (line + 2) * line_height
+        x = rng.randint(width // 20, width // 8)
+        while x < width * 0.9:
+            # A "word" is a short zig-zag stroke
+            word_width = rng.randint(width // 40, width // 10)
+            points = [(x + i * word_width / 8, y + rng.randint(-line_height // 3, line_height // 3)) for i in range(9)]
+            draw.line(points, fill=(20, 20, 60), width=max(1, width // 400))
+            x += word_width + rng.randint(width // 80, width // 30)
+    return page
+
+def write_pdf(path, page_count, rng, page_size=(850, 1100)):
+    """Write a multi-page PDF of fake handwritten pages"""
+    pages = [draw_page(page_size[0], page_size[1], rng) for _ in range(page_count)]
+    pages[0].save(path, "PDF", resolution=100, save_all=True, append_images=pages[1:])
+
+def generate_gradebook(root, students, pages, files_per_student, mix, photo_size, seed, copies=0.0):
+    """Create a fake Blackboard gradebook export plus question and solution PDFs under root"""
+    rng = random.Random(seed)
+    gradebook_dir = os.path.join(root, "gradebook")
+    os.makedirs(gradebook_dir, exist_ok=True)
+
+    question_path = os.path.join(root, "question.pdf")
+    solution_path = os.path.join(root, "solution.pdf")
+    write_pdf(question_path, 2, rng)
+    write_pdf(solution_path, 5, rng)
+
+    kinds, weights = zip(*mix.items())
+    uploads = []  # (original filename, path) of each student's files, for copied homework
+    for n in range(students):
+        student_id = f"stu{n:04d}"
+        attempt = f"2025-02-{rng.randint(20, 24):02d}-{rng.randint(0, 23):02d}-{rng.randint(0, 59):02d}-{rng.randint(0, 59):02d}"
+        prefix = f"Homework 3_{student_id}_attempt_{attempt}"
+
+        file_lines = []
+        student_uploads = []
+        if n and rng.random() < copies:
+            # Copied homework: another student's files, byte for byte or (for images) re-saved as a near-identical copy
+            source = rng.choice(uploads)
+            for original_filename, source_path in source:
+                filename = f"{prefix}_{original_filename}"
+                path = os.path.join(gradebook_dir, filename)
+                if source_path.endswith(".pdf") or rng.random() < 0.5:
+                    shutil.copyfile(source_path, path)
+                else:
+                    with Image.open(source_path) as img:
+                        img.convert("RGB").save(path, "JPEG" if path.endswith(".jpg") else "PNG", quality=80)
+                file_lines += [f"\tOriginal filename: {original_filename}", f"\tFilename: {filename}"]
+            uploads.append(source)
+        for file_number in range(0 if file_lines else rng.randint(1, files_per_student)):
+            kind = rng.choices(kinds, weights)[0]
+            original_filename = f"hw3_part{file_number + 1}.{kind}"
+            filename = f"{prefix}_{original_filename}"
+            path = os.path.join(gradebook_dir, filename)
+            if kind == "pdf":
+                write_pdf(path, pages, rng)
+            elif kind == "jpg":
+                # Phone photo: large, off-white paper
+                draw_page(photo_size[0], photo_size[1], rng, background=(236, 230, 214)).save(path, "JPEG", quality=90)
+            else:
+                # Scanner PNG at 200 dpi
+                draw_page(1700, 2200, rng).save(path, "PNG")
+            file_lines += [f"\tOriginal filename: {original_filename}", f"\tFilename: {filename}"]
+            student_uploads.append((original_filename, path))
+        if student_uploads:
+            uploads.append(student_uploads)
+
+        with open(os.path.join(gradebook_dir, f"{prefix}.txt"), 'w') as f:
+            f.write("\n".join([
+                f"Name: Student {n:04d} ({student_id})",
+                "Assignment: Homework 3",
+                f"Date Submitted: {attempt}",
+                "Current Grade: Needs Grading",
+                "",
+                "Submission Field:",
+                "There is no student submission text data for this assignment.",
+                "",
+                "Comments:",
+                "There are no student comments for this assignment.",
+                "",
+                "Files:"
+            ] + file_lines) + "\n")
+
+    return gradebook_dir, question_path, solution_path
+
+class StubAPI:
+    """State shared by the stub server's request handlers"""
+
+    def __init__(self, latency, latency_jitter, rate_429, retry_after, seed, drop_problem=0.0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.drop_problem = drop_problem
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"messages": 0, "rate_limited": 0, "batches": 0, "batch_requests": 0, "followups": 0,
+                      "files_uploaded": 0, "message_bytes": 0, "models": {}}
+        self.batches = {}
+        self.files = {}
+        self.base_url = None
+
+    def fake_message(self, params):
+        """Build a Messages API response with a random but well-formed grading (or page index, in --per-problem mode)"""
+        content = params["messages"][0]["content"]
+        images = sum(1 for block in content if block.get("type") == "image")
+        documents = sum(1 for block in content if block.get("type") == "document")
+        text_chars = sum(len(block.get("text", "")) for block in content)
+        prompt = content[0].get("text", "")
+        # Follow the rubric in the tool schema (problem count and marks per problem)
+        count, max_score = 5, 20
+        if params.get("tools"):
+            problem_schema = params["tools"][0]["input_schema"]["properties"]["problems"]["items"]["properties"]
+            count, max_score = problem_schema["problem_number"].get("maximum", 5), problem_schema["score"].get("maximum", 20)
+        with self.lock:
+            scores = [round(max_score * self.rng.choice([1, 1, 0.9, 0.75, 0])) for _ in range(count)]
+            message_number = self.stats["messages"] + self.stats["batch_requests"]
+            dropped = self.rng.randrange(count) if self.rng.random() < self.drop_problem else None
+        problems = []
+        confidences = None
+        if params.get("tools") and "confidence" in params["tools"][0]["input_schema"]["properties"]["problems"]["items"]["properties"]:
+            with self.lock:
+                confidences = [self.rng.choice([0.95, 0.9, 0.85, 0.6]) for _ in range(count)]
+        for number, score in enumerate(scores, start=1):
+            problem = {"problem_number": number, "score": score, "max_score": max_score}
+            if confidences:
+                problem["confidence"] = confidences[number - 1]
+            if score < max_score:
+                problem["feedback"] = "Stub feedback."
+            problems.append(problem)
+        grading = {"problems": problems, "overall_score": sum(scores), "overall_max": count * max_score, "overall_feedback": "Stub grading."}
+        if len(params["messages"]) > 1:
+            # Follow-up turn: answer only the problems asked for again
+            followup = params["messages"][-1]["content"][0]
+            asked = re.search(r"Problem\(s\) ([\d, ]+) are", followup.get("content") or followup.get("text", ""))
+            numbers = [int(number) for number in asked.group(1).split(",")] if asked else []
+            grading["problems"] = [problem for problem in problems if problem["problem_number"] in numbers]
+            with self.lock:
+                self.stats["followups"] += 1
+        single_problem = re.search(r"grading problem (\d+) of", prompt)
+        if single_problem:
+            grading = problems[int(single_problem.group(1)) - 1]
+        elif '"pages"' in prompt:
+            # Page index request: spread the problems over the pages in order
+            grading = {"pages": [{"page": page, "problems": [min(5, 1 + (page - 1) * 5 // images)]}
+                                 for page in range(1, images + 1)]}
+        elif dropped is not None and len(params["messages"]) == 1:
+            # Only whole-submission gradings leave a problem out; copy so the list above stays whole
+            grading["problems"] = [problem for index, problem in enumerate(problems) if index != dropped]
+        if params.get("tools"):
+            content = [{"type": "tool_use", "id": f"toolu_stub_{message_number}", "name": params["tools"][0]["name"], "input": grading}]
+        else:
+            content = [{"type": "text", "text": json.dumps(grading)}]
+        return {
+            "id": f"msg_stub_{message_number}",
+            "type": "message",
+            "role": "assistant",
+            "model": params.get("model", "stub"),
+            "content": content,
+            "stop_reason": "tool_use" if params.get("tools") else "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": images * 600 + documents * 4000 + text_chars // 4, "output_tokens": 250,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        }
+
+    def batch_object(self, batch_id):
+        """Build a MessageBatch object; batches end once the configured latency has passed"""
+        batch = self.batches[batch_id]
+        ended = time.time() - batch["created"] >= self.latency
+        count = len(batch["requests"])
+        created_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(batch["created"]))
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0,
+                               "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": created_at,
+            "expires_at": created_at,
+            "ended_at": created_at if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+def make_handler(stub):
+    """Request handler class for the stub Messages, Message Batches endpoints"""
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length)
+
+        def unknown_files(self, params):
+            """file_ids referenced by a Messages request that were never uploaded"""
+            file_ids = [block["source"]["file_id"] for block in params["messages"][0]["content"]
+                        if block.get("type") == "document" and block["source"].get("type") == "file"]
+            return [file_id for file_id in file_ids if file_id not in stub.files]
+
+        def do_POST(self):
+            path = self.path.split("?")[0]
+            body = self.read_body()
+            if path == "/v1/files":
+                # Multipart upload; the stub only needs the size and the filename
+                filename = re.search(rb'filename="([^"]*)"', body)
+                with stub.lock:
+                    file_id = f"file_stub_{len(stub.files)}"
+                    stub.files[file_id] = {"id": file_id, "type": "file", "filename": filename.group(1).decode() if filename else "upload",
+                                           "mime_type": "application/pdf", "size_bytes": len(body),
+                                           "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "downloadable": False}
+                    stub.stats["files_uploaded"] += 1
+                self.send_json(200, stub.files[file_id])
+                return
+            params = json.loads(body or b"{}")
+            if path == "/v1/messages" and self.unknown_files(params):
+                self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": f"File not found: {self.unknown_files(params)[0]}"}})
+            elif path == "/v1/messages":
+                with stub.lock:
+                    stub.stats["message_bytes"] += len(body)
+                # Smaller models answer faster
+                speed = 0.4 if "haiku" in params.get("model", "") else 1.0
+                time.sleep(max(0.0, stub.rng.gauss(stub.latency * speed, stub.latency_jitter * speed)))
+                with stub.lock:
+                    limited = stub.rng.random() < stub.rate_429
+                    stub.stats["rate_limited" if limited else "messages"] += 1
+                    if not limited:
+                        stub.stats["models"][params.get("model")] = stub.stats["models"].get(params.get("model"), 0) + 1
+                if limited:
+                    self.send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Stub rate limit"}},
+                                   {"retry-after": str(stub.retry_after), "anthropic-ratelimit-requests-remaining": "0"})
+                else:
+                    self.send_json(200, stub.fake_message(params))
+            elif path == "/v1/messages/batches":
+                with stub.lock:
+                    batch_id = f"msgbatch_stub_{len(stub.batches)}"
+                    stub.batches[batch_id] = {"created": time.time(), "requests": params["requests"]}
+                    stub.stats["batches"] += 1
+                    stub.stats["batch_requests"] += len(params["requests"])
+                self.send_json(200, stub.batch_object(batch_id))
+            else:
+                self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+
+        def do_GET(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            if len(parts) == 3 and parts[:2] == ["v1", "files"] and parts[2] in stub.files:
+                self.send_json(200, stub.files[parts[2]])
+            elif len(parts) >= 4 and parts[:3] == ["v1", "messages", "batches"] and parts[3] in stub.batches:
+                batch_id = parts[3]
+                if len(parts) == 5 and parts[4] == "results":
+                    lines = [json.dumps({"custom_id": request["custom_id"],
+                                         "result": {"type": "succeeded", "message": stub.fake_message(request["params"])}})
+                             for request in stub.batches[batch_id]["requests"]]
+                    self.send_json(200, ("\n".join(lines) + "\n").encode('utf-8'))
+                else:
+                    self.send_json(200, stub.batch_object(batch_id))
+            else:
+                self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    return StubHandler
+
+def start_stub_server(stub, port=0):
+    """Start the stub API on a background thread and return the server"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(stub))
+    server.daemon_threads = True
+    stub.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_grader(base_url, gradebook_dir, question_path, solution_path, output_dir, settings, grader_args):
+    """Run grade_homework.main() against the stub API (in a child process, so peak memory is its own)"""
+    import grade_homework
+    from anthropic import Anthropic
+
+    grade_homework.anthropic_client = Anthropic(api_key="stub-key", base_url=base_url, max_retries=0)
+    grade_homework.student_dir = gradebook_dir
+    grade_homework.question_path = question_path
+    grade_homework.solution_path = solution_path
+    grade_homework.set_output_dir(output_dir)
+    if settings["processes"] > 1:
+        # Concurrent graders share output_dir (and its job queue) but each writes its own run report
+        grade_homework.metrics_json_path = os.path.join(output_dir, f"run_metrics.{settings['process_index']}.json")
+        grade_homework.metrics_prom_path = os.path.join(output_dir, f"run_metrics.{settings['process_index']}.prom")
+    grade_homework.max_concurrent_requests = settings["workers"]
+    grade_homework.rate_limiter = grade_homework.RateLimiter(settings["rpm"], settings["itpm"])
+    grade_homework.batch_poll_interval = 1
+    grade_homework.main(grader_args)
+
+def parse_mix(text):
+    """Parse a file-type mix like 'pdf=0.6,jpg=0.3,png=0.1'"""
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip().lower()] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark grade_homework.py against a synthetic gradebook and a stub API")
+    parser.add_argument("--workdir", default="benchmark_workdir", help="where the fake gradebook and outputs are written")
+    parser.add_argument("--students", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=4, help="pages per PDF upload")
+    parser.add_argument("--files-per-student", type=int, default=2, help="each student uploads 1..N files")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("pdf=0.6,jpg=0.3,png=0.1"), help="upload type weights")
+    parser.add_argument("--photo-size", type=int, nargs=2, default=[3024, 4032], help="phone photo width and height")
+    parser.add_argument("--latency", type=float, default=2.0, help="mean stub API latency in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with injected 429s")
+    parser.add_argument("--copies", type=float, default=0.0, help="fraction of students who hand in a copy of another student's files")
+    parser.add_argument("--drop-problem", type=float, default=0.0, help="fraction of gradings that leave out one problem")
+    parser.add_argument("--workers", type=int, default=8, help="grade_homework.max_concurrent_requests")
+    parser.add_argument("--processes", type=int, default=1, help="grader processes to run at once (use with -- --worker)")
+    parser.add_argument("--rpm", type=float, default=4000, help="rate limiter requests per minute")
+    parser.add_argument("--itpm", type=float, default=2000000, help="rate limiter input tokens per minute")
+    parser.add_argument("--seed", type=int, default=317)
+    parser.add_argument("--regenerate", action="store_true", help="rebuild the fake gradebook even if it exists")
+    parser.add_argument("--warm", action="store_true", help="keep caches from the previous benchmark run")
+    parser.add_argument("--report", help="also write the benchmark report as JSON to this path")
+    args, grader_args = parser.parse_known_args()
+    grader_args = [arg for arg in grader_args if arg != "--"]
+    # With a run spec (-- --assignments spec.json) each assignment writes its run report to its own output_dir
+    spec_parser = argparse.ArgumentParser(add_help=False)
+    spec_parser.add_argument("--assignments")
+    run_spec = spec_parser.parse_known_args(grader_args)[0].assignments
+    if run_spec and args.processes > 1:
+        parser.error("--processes can't be combined with a run spec; concurrent graders would overwrite each assignment's run report")
+
+    workdir = os.path.abspath(args.workdir)
+    gradebook_dir = os.path.join(workdir, "gradebook")
+    question_path = os.path.join(workdir, "question.pdf")
+    solution_path = os.path.join(workdir, "solution.pdf")
+    if args.regenerate or not os.path.isdir(gradebook_dir):
+        print(f"Generating a fake gradebook with {args.students} students in {workdir}...")
+        start = time.perf_counter()
+        generate_gradebook(workdir, args.students, args.pages, args.files_per_student, args.mix, args.photo_size, args.seed, args.copies)
+        print(f"Generated in {time.perf_counter() - start:.1f} seconds")
+
+    output_dir = os.path.join(workdir, "graded_results")
+    if not args.warm and os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+
+    stub = StubAPI(args.latency, args.latency_jitter, args.rate_429, args.retry_after, args.seed, args.drop_problem)
+    server = start_stub_server(stub)
+    print(f"Stub API listening on {stub.base_url}")
+
+    start = time.perf_counter()
+    graders = []
+    for process_index in range(args.processes):
+        settings = {"workers": args.workers, "rpm": args.rpm, "itpm": args.itpm,
+                    "processes": args.processes, "process_index": process_index}
+        grader = multiprocessing.Process(target=run_grader, args=(stub.base_url, gradebook_dir, question_path, solution_path,
+                                                                 output_dir, settings, grader_args))
+        grader.start()
+        graders.append(grader)
+    for grader in graders:
+        grader.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    # ru_maxrss is in kilobytes on Linux; the children figure is the largest single child (grader or poppler)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    if run_spec:
+        import grade_homework
+        report_paths = [os.path.join(assignment["output_dir"], "run_metrics.json") for assignment in grade_homework.load_run_spec(run_spec)]
+    else:
+        report_paths = [os.path.join(output_dir, "run_metrics.json" if args.processes == 1 else f"run_metrics.{process_index}.json")
+                        for process_index in range(args.processes)]
+    summaries = []
+    for report_path in report_paths:
+        with open(report_path, 'r') as f:
+            summaries.append(json.load(f))
+    run_summary = summaries[0]
+
+    graded = sum(summary["students_graded"] for summary in summaries)
+    report = {
+        "students": args.students,
+        "graded": graded,
+        "wall_seconds": elapsed,
+        "submissions_per_minute": graded / elapsed * 60 if elapsed > 0 else 0,
+        "peak_rss_mb": peak_rss_mb,
+        "grader_exit_codes": [grader.exitcode for grader in graders],
+        "graded_per_assignment" if run_spec else "graded_per_process": [summary["students_graded"] for summary in summaries],
+        "stub": stub.stats,
+        "tokens": run_summary["totals"],
+        "stages": run_summary["stages"]
+    }
+
+    print("\nBenchmark results")
+    if run_spec:
+        # The spec's assignments need not be the generated gradebook, so there is no expected total
+        print(f"  Graded {graded} submissions in {elapsed:.1f} s ({report['submissions_per_minute']:.1f}/min)")
+        print(f"  Graded per assignment: {report['graded_per_assignment']}")
+    else:
+        print(f"  Graded {graded}/{args.students} submissions in {elapsed:.1f} s ({report['submissions_per_minute']:.1f}/min)")
+    if args.processes > 1:
+        print(f"  Graded per process: {report['graded_per_process']}")
+    print(f"  Peak RSS: {peak_rss_mb:.0f} MB")
+    print(f"  Stub: {stub.stats['messages']} messages, {stub.stats['rate_limited']} injected 429s, "
+          f"{stub.stats['batch_requests']} batched requests, {stub.stats['followups']} follow-ups, "
+          f"{stub.stats['files_uploaded']} file uploads, {stub.stats['message_bytes'] / max(1, stub.stats['messages']) / 1024:.0f} KB per message")
+    if len(stub.stats["models"]) > 1:
+        print(f"  Messages per model: {stub.stats['models']}")
+    if args.processes > 1 or len(summaries) > 1:
+        print(f"  Stage timings of the first {'assignment' if run_spec else 'process'}:")
+    print(f"  {'stage':<20}{'count':>8}{'total s':>10}{'p50 s':>10}{'p95 s':>10}")
+    for stage, stats in run_summary["stages"].items():
+        print(f"  {stage:<20}{stats['count']:>8}{stats['total_seconds']:>10.2f}{stats['p50_seconds']:>10.3f}{stats['p95_seconds']:>10.3f}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+
+if __name__ == "__main__":
+    main()
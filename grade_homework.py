@@ -1,504 +1,2607 @@
 import os
 import json
-import pandas as pd
-from anthropic import Anthropic
+import re
+import numpy as np
+from anthropic import Anthropic, APIStatusError, APIConnectionError, NotFoundError
 import base64
-from pdf2image import convert_from_path
+import hashlib
+import shutil
+from pdf2image import convert_from_path, pdfinfo_from_path
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 import time
 import random
+import math
+import csv
+import sqlite3
+import socket
+import signal
+import argparse
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 
 # Initialize Anthropic client with your API key
+# Retries are handled by create_message() so every attempt goes through the shared rate limiter.
+# Set ANTHROPIC_BASE_URL to point the client at a local stub server for testing.
 anthropic_api_key = ""  # Replace with your actual API key
-anthropic_client = Anthropic(api_key=anthropic_api_key)
+anthropic_client = Anthropic(api_key=anthropic_api_key, max_retries=0)
 
 # Paths
 student_dir = "/ssd_4TB/divake/BB_ECE317/gradebook"
 question_path = "/ssd_4TB/divake/BB_ECE317/ECE_317_Homework_3_Question.pdf"
 solution_path = "/ssd_4TB/divake/BB_ECE317/HW3_Solution.pdf"
 output_dir = "/ssd_4TB/divake/BB_ECE317/graded_results"
+receipt_prefix = "Homework 3_"  # Blackboard names receipts "Homework 3_<id>_attempt_<timestamp>.txt"
+problem_count = 5  # Rubric; use set_rubric() to change it, since the prompts and tool schemas are rendered from it
+problem_max_score = 20
+supported_extensions = ['pdf', 'jpg', 'jpeg', 'png']
+result_cache_dir = os.path.join(output_dir, "result_cache")  # Finished results keyed by a hash of everything that affects grading
+page_cache_dir = os.path.join(output_dir, "page_cache")  # Rasterized, compressed JPEG pages keyed by file hash and render settings
+page_cache_max_bytes = 2 * 1024 ** 3  # Least recently used entries are evicted beyond this size
 
-# Create output directory if it doesn't exist
-os.makedirs(output_dir, exist_ok=True)
+# Run spec (--assignments spec.json): grade several assignments or sections in one run, e.g.
+# {"page_cache_dir": "/ssd_4TB/divake/page_cache",
+#  "assignments": [{"name": "HW3", "student_dir": "...", "question_path": "...", "solution_path": "...",
+#                   "output_dir": "...", "receipt_prefix": "Homework 3_", "problem_count": 5, "problem_max_score": 20}]}
+# problem_count, problem_max_score, name and page_cache_dir are optional.
 
-def pdf_to_images(pdf_path, dpi=100, max_pages=None):
-    """Convert PDF to a list of images with reduced quality"""
-    print(f"Converting PDF to images: {pdf_path}")
-    try:
-        pages = convert_from_path(pdf_path, dpi=dpi)
+# Concurrency settings
+max_concurrent_requests = 4  # Number of messages.create calls allowed in flight at once (1 = serial)
+prefetch_processes = os.cpu_count() or 2  # Worker processes rasterizing and encoding upcoming students
+prefetch_depth = 8  # Students prepared ahead of the API stage; bounds how many page sets sit in memory
+
+# Page filtering settings (applied across all of a student's files before upload)
+drop_blank_pages = True
+drop_duplicate_pages = True
+blank_ink_coverage = 0.0015  # Pages with less ink than this fraction of their area count as blank
+ink_contrast = 24  # Gray levels below the page background for a pixel to count as ink
+duplicate_hash_distance = 6  # Max differing bits (of 63) between perceptual hashes of duplicate pages
+duplicate_pixel_difference = 32  # Max mean gray-level difference over the ink of two 256 px thumbnails for them to be duplicates
+
+# Scan cleanup before encoding: crop to the written area, grayscale, and even out lighting and contrast
+clean_scans = True
+binarize_scans = False  # Pure black and white; smallest pages, but loses faint pencil strokes
+crop_padding = 0.02  # Margin kept around the ink bounding box, as a fraction of the page's long side
+
+# Per-request budgets; big submissions are shrunk to fit instead of failing (keep the token budget under input_tokens_per_minute)
+request_token_budget = 30000  # Estimated input tokens for prompt, reference pages and student pages together
+request_byte_budget = 24 * 1024 * 1024  # base64 payload per request (the API rejects requests over 32 MB)
+min_page_side = 400  # Pages are never shrunk below this many pixels on their long side, to stay legible
+min_jpeg_quality = 20
+
+# Native PDFs (--native-pdfs): small student PDFs are sent as document blocks instead of being rasterized locally
+send_native_pdfs = False
+native_pdf_max_pages = 20  # Longer PDFs (usually phone scans of every sheet) are rasterized so they can be shrunk
+native_pdf_max_bytes = 4 * 1024 * 1024  # Bigger files are scans; their pages are cheaper as our compressed JPEGs
+
+# Model settings
+grading_model = "claude-3-7-sonnet-20250219"
+system_prompt = "You are a Digital Signal Processing teaching assistant. Grade homework submissions accurately and fairly, focusing only on the technical content. Format your response as JSON."
+
+# Model cascade (--cascade): a cheaper model grades first and only uncertain gradings are redone by grading_model
+use_model_cascade = False
+screening_model = "claude-3-5-haiku-20241022"
+escalation_confidence = 0.8  # A problem graded with less confidence than this sends the student to grading_model
+escalation_score_band = (0.75, 0.9)  # Partial-credit scores (as fractions of the problem's marks), which the screening model is least reliable at
+
+# Per-problem mode (--per-problem): index which pages show which problem, then grade each problem in its own request
+per_problem_grading = False
+problem_retries = 2  # Extra attempts for a problem whose response can't be parsed, without regrading the others
+
+# Follow-up turns asking only for the problems a grading left out or got wrong
+max_grading_followups = 2
+# Cache breakpoint after the student pages: follow-ups and retries read the pages from cache, but every request pays
+# the cache-write premium on them; only worth it when most gradings need a follow-up
+cache_student_pages = False
+index_page_scale = 0.5  # Pages are downscaled this much for indexing, since only problem numbers need to be read
+
+# Rate limit settings (starting budgets for our API tier; refined from the anthropic-ratelimit-* response headers)
+requests_per_minute = 50
+input_tokens_per_minute = 40000
+max_retries = 5
+base_delay = 10  # seconds, backoff used when the API doesn't send retry-after
+
+# Message Batches settings (--batch mode)
+batch_dir = os.path.join(output_dir, "batches")  # Manifests of submitted batches, so an interrupted run can collect them later
+batch_max_requests = 10000  # API limit is 100,000 requests per batch
+batch_max_bytes = 200 * 1024 * 1024  # API limit is 256 MB per batch
+batch_poll_interval = 60  # seconds between batch status checks
+
+# Files API (--upload-references): reference PDFs are uploaded once and sent as file_id document blocks
+upload_reference_files = False
+files_api_beta = "files-api-2025-04-14"
+reference_files_path = os.path.join(output_dir, "reference_files.json")  # SHA-256 of each uploaded PDF -> file_id, reused across runs
+pdf_page_tokens = 2000  # Rough input tokens per page of a PDF document block (page image plus extracted text)
+
+# Results database (one row per submission; the Blackboard CSV is exported from it)
+results_db_path = os.path.join(output_dir, "grading_results.db")
+results_db_shared = False  # Set by --worker: other processes (maybe on other machines) write the same database
+
+# Watch mode settings (--watch)
+watch_interval = 5  # seconds between scans of student_dir; a new submission is graded after two unchanged scans
+watch_retry_max_interval = 300  # seconds; a failed submission is retried after watch_interval, doubling up to this
+
+# Job queue settings (--worker mode; the queue lives in output_dir, which all workers must share)
+job_queue_path = os.path.join(output_dir, "job_queue.db")
+job_lease_seconds = 600  # A worker that stops heartbeating loses its students to other workers after this long
+job_poll_interval = 5  # seconds between checks while other workers still hold leases
+max_job_attempts = 3  # Students that fail this many times are left for a human to look at
+
+# Duplicate submission settings: identical submissions across students are graded once and the result shared
+group_duplicate_submissions = True
+report_near_identical_pages = True  # Also list submissions whose every page matches; each is still graded on its own
+near_identical_ink_overlap = 0.5  # Min share of two pages' combined ink (256 px masks) that both have, for the pages to match
+duplicate_groups_path = os.path.join(output_dir, "duplicate_groups.json")  # Report of the groups, for plagiarism review
+
+# Run report settings
+metrics_json_path = os.path.join(output_dir, "run_metrics.json")
+metrics_prom_path = os.path.join(output_dir, "run_metrics.prom")  # Prometheus node_exporter textfile format
+
+# Grading prompt, sent once per request ahead of the question and solution pages (rendered for the rubric by set_rubric)
+grading_prompt_template = """
+You are an expert teaching assistant grading a Digital Signal Processing (ECE317) homework assignment.
+
+I have provided multiple images in the following order:
+1. First set: The homework questions
+2. Second set: The solution to the assignment
+3. Third set: The student's submission
+
+This homework has {problem_count} questions, each worth {max_score} marks (for a total of {total_score} marks).
+
+Please grade this submission carefully, following these specific guidelines:
+- Award full marks ({max_score}) if the answer is perfect and matches the solution
+- Award partial marks ({partial_low}-{partial_high}) if the answer is partially correct or has minor errors
+- Award 0 marks if the question is not attempted
+- Be generous with partial credit (prefer to give {partial_high}-{partial_low} rather than lower scores)
+
+For ONLY the questions that did NOT receive full marks ({max_score}), provide a single line of 
+feedback explaining why marks were deducted. The feedback should be very brief and to the point.
+
+Record your grading with the record_grades tool, using the following structure:
+{{
+    "problems": [
+        {{
+            "problem_number": 1,
+            "score": {max_score},  // Full marks example, no feedback needed
+            "max_score": {max_score}
+        }},
+        {{
+            "problem_number": 2,
+            "score": {partial_high},  // Partial marks example
+            "max_score": {max_score},
+            "feedback": "Missed the aliasing explanation in the frequency domain."
+        }},
+        // Repeat for all {problem_count} questions
+    ],
+    "overall_score": Z,  // Sum of all {problem_count} question scores
+    "overall_max": {total_score},
+    "overall_feedback": "Brief summary of the student's overall performance"
+}}
+
+Ensure you grade all {problem_count} questions.
+"""
+
+# Tool the grading response is constrained to, so it always arrives as schema-shaped JSON
+grading_tool = {
+    "name": "record_grades",
+    "description": "Record the grade and feedback for each homework problem of one student's submission.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "problems": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "problem_number": {"type": "integer", "minimum": 1},
+                        "score": {"type": "number", "minimum": 0},
+                        "max_score": {"type": "number"},
+                        "feedback": {"type": "string", "description": "One line; only for problems without full marks"}
+                    },
+                    "required": ["problem_number", "score", "max_score"]
+                }
+            },
+            "overall_score": {"type": "number", "description": "Sum of the problem scores"},
+            "overall_max": {"type": "number"},
+            "overall_feedback": {"type": "string"}
+        },
+        "required": ["problems", "overall_score", "overall_max", "overall_feedback"]
+    }
+}
+
+# In cascade mode the screening model also reports how sure it is of each score
+screening_confidence_schema = {
+    "type": "number", "minimum": 0, "maximum": 1,
+    "description": "How certain you are of this score, from 0 (guess) to 1 (certain); be honest about illegible or unusual answers"
+}
+
+# Page index prompt, used in --per-problem mode to find the pages that belong to each problem
+page_index_prompt_template = """
+The images below are pages of a Digital Signal Processing (ECE317) homework document, each labelled with its page number.
+The homework has {problem_count} questions, numbered 1 to {problem_count}.
+
+For each page, list the question numbers that appear on it: the question statement, its worked solution, or a
+student's answer to it. A question that continues from the previous page counts on both pages. Use an empty list
+for pages with no question content (cover pages, blank pages).
+
+Format your response as JSON with the following structure:
+{{
+    "pages": [
+        {{"page": 1, "problems": [1, 2]}},
+        {{"page": 2, "problems": [2]}}
+    ]
+}}
+
+Return only the JSON with no additional text. Include every page.
+"""
+
+# Per-problem grading prompt, sent ahead of the question, solution and student pages for a single problem
+# (formatted with the problem number and rubric_fields())
+problem_prompt = """
+You are an expert teaching assistant grading problem {problem_number} of a Digital Signal Processing (ECE317) homework assignment.
+
+I have provided the pages relevant to problem {problem_number} in the following order:
+1. First set: The homework question
+2. Second set: The solution
+3. Third set: The student's submission
+
+The pages may also show other problems; grade ONLY problem {problem_number}, which is worth {max_score} marks.
+
+Please grade it carefully, following these specific guidelines:
+- Award full marks ({max_score}) if the answer is perfect and matches the solution
+- Award partial marks ({partial_low}-{partial_high}) if the answer is partially correct or has minor errors
+- Award 0 marks if the question is not attempted
+- Be generous with partial credit (prefer to give {partial_high}-{partial_low} rather than lower scores)
+
+If the answer did NOT receive full marks, provide a single line of feedback explaining why marks were deducted.
+The feedback should be very brief and to the point.
+
+Format your response as JSON with the following structure:
+{{
+    "problem_number": {problem_number},
+    "score": {partial_high},
+    "max_score": {max_score},
+    "feedback": "Missed the aliasing explanation in the frequency domain."  // Omit for full marks
+}}
+
+Return only the JSON with no additional text.
+"""
+
+def rubric_fields():
+    """Values the prompt templates are filled in with for the current rubric"""
+    return {
+        "problem_count": problem_count,
+        "max_score": problem_max_score,
+        "total_score": problem_count * problem_max_score,
+        "partial_low": round(problem_max_score * 0.75),
+        "partial_high": round(problem_max_score * 0.9)
+    }
+
+def set_rubric(count, max_score):
+    """Set the number of problems and marks per problem, and render the prompts and tool schemas for them"""
+    global problem_count, problem_max_score, grading_prompt, page_index_prompt, screening_tool
+    problem_count = count
+    problem_max_score = max_score
+    grading_prompt = grading_prompt_template.format(**rubric_fields())
+    page_index_prompt = page_index_prompt_template.format(**rubric_fields())
+    properties = grading_tool["input_schema"]["properties"]
+    properties["problems"]["items"]["properties"]["problem_number"]["maximum"] = count
+    properties["problems"]["items"]["properties"]["score"]["maximum"] = max_score
+    properties["problems"]["items"]["properties"]["max_score"]["enum"] = [max_score]
+    properties["overall_max"]["enum"] = [count * max_score]
+    screening_tool = json.loads(json.dumps(grading_tool))
+    screening_tool["input_schema"]["properties"]["problems"]["items"]["properties"]["confidence"] = screening_confidence_schema
+    screening_tool["input_schema"]["properties"]["problems"]["items"]["required"].append("confidence")
+
+set_rubric(problem_count, problem_max_score)
+
+def load_run_spec(path):
+    """Read the assignments listed in a JSON run spec, filling in the defaults each one leaves out"""
+    with open(path) as f:
+        spec = json.load(f)
+    assignments = []
+    for number, entry in enumerate(spec["assignments"], start=1):
+        missing = [key for key in ["student_dir", "question_path", "solution_path", "output_dir", "receipt_prefix"] if key not in entry]
+        if missing:
+            raise ValueError(f"assignment {number} is missing {', '.join(missing)}")
+        assignment = {
+            "name": entry["receipt_prefix"].rstrip("_ "),
+            "problem_count": problem_count,
+            "problem_max_score": problem_max_score,
+            # One page cache for the whole run, so references shared by several sections are rasterized once
+            "page_cache_dir": spec.get("page_cache_dir", os.path.join(spec["assignments"][0]["output_dir"], "page_cache"))
+        }
+        assignment.update(entry)
+        assignments.append(assignment)
+    if not assignments:
+        raise ValueError("no assignments listed")
+    return assignments
+
+def configure_assignment(assignment):
+    """Point the paths, receipt prefix and rubric at one assignment from a run spec"""
+    global student_dir, question_path, solution_path, receipt_prefix, page_cache_dir
+    student_dir = assignment["student_dir"]
+    question_path = assignment["question_path"]
+    solution_path = assignment["solution_path"]
+    receipt_prefix = assignment["receipt_prefix"]
+    set_output_dir(assignment["output_dir"])
+    page_cache_dir = assignment["page_cache_dir"]
+    set_rubric(int(assignment["problem_count"]), assignment["problem_max_score"])
+
+def set_output_dir(path):
+    """Point output_dir and everything kept under it (caches, batch manifests, run reports) at another directory"""
+    global output_dir, result_cache_dir, page_cache_dir, batch_dir, metrics_json_path, metrics_prom_path, results_db_path, job_queue_path
+    global reference_files_path, duplicate_groups_path
+    output_dir = path
+    duplicate_groups_path = os.path.join(path, "duplicate_groups.json")
+    results_db_path = os.path.join(path, "grading_results.db")
+    reference_files_path = os.path.join(path, "reference_files.json")
+    job_queue_path = os.path.join(path, "job_queue.db")
+    result_cache_dir = os.path.join(path, "result_cache")
+    page_cache_dir = os.path.join(path, "page_cache")
+    batch_dir = os.path.join(path, "batches")
+    metrics_json_path = os.path.join(path, "run_metrics.json")
+    metrics_prom_path = os.path.join(path, "run_metrics.prom")
+
+class RunMetrics:
+    """Per-stage timings, token usage and payload sizes collected over one grading run"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}  # stage -> list of durations in seconds
+        self.counters = {}  # name -> count
+        self.students = {}  # submission identifier -> usage and payload totals
+    
+    @contextmanager
+    def timed(self, stage):
+        """Record how long the with-block takes under the given stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+    
+    def record(self, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def drain(self):
+        """Return and clear the timings and counters collected so far (used to ship them out of worker processes)"""
+        with self.lock:
+            drained = {"timings": self.timings, "counters": self.counters}
+            self.timings, self.counters = {}, {}
+            return drained
+    
+    def merge(self, drained):
+        """Add timings and counters drained from another RunMetrics"""
+        with self.lock:
+            for stage, durations in drained["timings"].items():
+                self.timings.setdefault(stage, []).extend(durations)
+            for name, value in drained["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+    
+    def record_student(self, student_identifier, **values):
+        """Add token usage, payload bytes, etc. to a student's totals"""
+        with self.lock:
+            totals = self.students.setdefault(student_identifier, {})
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0) + (value or 0)
+    
+    def student_totals(self, student_identifier):
+        """A copy of one student's usage and payload totals so far"""
+        with self.lock:
+            return dict(self.students.get(student_identifier, {}))
+    
+    def record_usage(self, student_identifier, usage):
+        """Record the token counts from a response's usage block"""
+        self.record_student(
+            student_identifier,
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", 0),
+            cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", 0)
+        )
+    
+    def summary(self):
+        """Summarize the run: latency percentiles per stage, throughput and token totals"""
+        with self.lock:
+            elapsed = time.time() - self.started
+            stages = {}
+            for stage, durations in sorted(self.timings.items()):
+                durations = sorted(durations)
+                stages[stage] = {
+                    "count": len(durations),
+                    "total_seconds": sum(durations),
+                    "p50_seconds": _percentile(durations, 50),
+                    "p95_seconds": _percentile(durations, 95),
+                    "max_seconds": durations[-1]
+                }
+            totals = {}
+            for student_totals in self.students.values():
+                for name, value in student_totals.items():
+                    totals[name] = totals.get(name, 0) + value
+            # Requests not made for any one student (e.g. indexing the reference pages) are recorded under None
+            graded = sum(1 for identifier, student_totals in self.students.items()
+                         if identifier is not None and student_totals.get("output_tokens"))
+            return {
+                "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                "elapsed_seconds": elapsed,
+                "students_graded": graded,
+                "students_per_minute": graded / elapsed * 60 if elapsed > 0 else 0,
+                "totals": totals,
+                "counters": dict(self.counters),
+                "stages": stages,
+                "students": {identifier: dict(values) for identifier, values in self.students.items()}
+            }
+    
+    def write_reports(self, json_path=None, prom_path=None):
+        """Write the run summary as JSON and as a Prometheus textfile"""
+        summary = self.summary()
+        json_path = json_path or metrics_json_path
+        prom_path = prom_path or metrics_prom_path
         
-        if max_pages and len(pages) > max_pages:
-            print(f"PDF has {len(pages)} pages, limiting to first {max_pages} pages")
-            pages = pages[:max_pages]
+        with open(json_path, 'w') as f:
+            json.dump(summary, f, indent=2)
         
-        return pages
-    except Exception as e:
-        print(f"Error converting PDF to images: {str(e)}")
-        return []
+        lines = [
+            "# HELP grading_stage_seconds Latency of each grading stage.",
+            "# TYPE grading_stage_seconds summary"
+        ]
+        for stage, stats in summary["stages"].items():
+            lines.append(f'grading_stage_seconds{{stage="{stage}",quantile="0.5"}} {stats["p50_seconds"]:.6f}')
+            lines.append(f'grading_stage_seconds{{stage="{stage}",quantile="0.95"}} {stats["p95_seconds"]:.6f}')
+            lines.append(f'grading_stage_seconds_sum{{stage="{stage}"}} {stats["total_seconds"]:.6f}')
+            lines.append(f'grading_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines += [
+            "# HELP grading_tokens_total Tokens reported by the API, by kind.",
+            "# TYPE grading_tokens_total counter"
+        ]
+        for name in ["input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"]:
+            lines.append(f'grading_tokens_total{{kind="{name[:-len("_tokens")]}"}} {summary["totals"].get(name, 0)}')
+        lines += [
+            "# HELP grading_payload_bytes_total Request payload bytes sent to the API.",
+            "# TYPE grading_payload_bytes_total counter",
+            f'grading_payload_bytes_total {summary["totals"].get("payload_bytes", 0)}',
+            "# HELP grading_events_total Cache hits, retries and other run events.",
+            "# TYPE grading_events_total counter"
+        ]
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f'grading_events_total{{event="{name}"}} {value}')
+        lines += [
+            "# HELP grading_students_graded Students graded through the API in this run.",
+            "# TYPE grading_students_graded gauge",
+            f'grading_students_graded {summary["students_graded"]}',
+            "# HELP grading_students_per_minute Throughput of this run.",
+            "# TYPE grading_students_per_minute gauge",
+            f'grading_students_per_minute {summary["students_per_minute"]:.4f}',
+            "# HELP grading_run_seconds Wall time of this run.",
+            "# TYPE grading_run_seconds gauge",
+            f'grading_run_seconds {summary["elapsed_seconds"]:.3f}'
+        ]
+        
+        # The textfile collector may read at any moment, so replace the file atomically
+        tmp_path = f"{prom_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, prom_path)
+        return summary
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+run_metrics = RunMetrics()
+
+def timed_stage(stage):
+    """Decorator that records every call of the function under the given stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with run_metrics.timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class RateLimiter:
+    """Token-bucket limiter shared by all workers for the requests and input-tokens per minute budgets"""
+    
+    def __init__(self, requests_per_minute, input_tokens_per_minute):
+        self.condition = threading.Condition()
+        self.limits = {"requests": float(requests_per_minute), "input-tokens": float(input_tokens_per_minute)}
+        self.budgets = dict(self.limits)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self):
+        """Top up both buckets at their per-minute rate; caller must hold the condition"""
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for kind, limit in self.limits.items():
+            self.budgets[kind] = min(limit, self.budgets[kind] + elapsed * limit / 60)
+        return now
+    
+    def acquire(self, input_tokens):
+        """Block until one request and input_tokens fit in the budgets, then spend them"""
+        with self.condition:
+            while True:
+                now = self._refill()
+                # A request larger than the whole token budget waits for a full bucket
+                needed = {"requests": 1.0, "input-tokens": min(float(input_tokens), self.limits["input-tokens"])}
+                wait_time = self.paused_until - now
+                if wait_time <= 0:
+                    wait_time = max((needed[kind] - self.budgets[kind]) * 60 / self.limits[kind] for kind in needed)
+                    if wait_time <= 0:
+                        for kind in needed:
+                            self.budgets[kind] -= needed[kind]
+                        return
+                self.condition.wait(wait_time)
+    
+    def update_from_headers(self, headers):
+        """Sync limits and remaining budgets with the anthropic-ratelimit-* response headers"""
+        with self.condition:
+            now = self._refill()
+            for kind in self.limits:
+                limit = _header_float(headers, f"anthropic-ratelimit-{kind}-limit")
+                remaining = _header_float(headers, f"anthropic-ratelimit-{kind}-remaining")
+                if limit:
+                    self.limits[kind] = limit
+                if remaining is not None:
+                    self.budgets[kind] = min(self.limits[kind], remaining)
+                    reset = _seconds_until(headers.get(f"anthropic-ratelimit-{kind}-reset"))
+                    if remaining < 1 and reset:
+                        self.paused_until = max(self.paused_until, now + reset)
+            self.condition.notify_all()
+    
+    def backoff(self, delay):
+        """Pause every worker for delay seconds, e.g. after a 429 with retry-after"""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.condition.notify_all()
+
+def _header_float(headers, name):
+    """Read a numeric header, returning None if it's missing or malformed"""
+    try:
+        value = headers.get(name)
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _seconds_until(timestamp):
+    """Seconds from now until an RFC 3339 reset timestamp, or None if it can't be parsed"""
+    if not timestamp:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+    except ValueError:
+        return None
+
+rate_limiter = RateLimiter(requests_per_minute, input_tokens_per_minute)
+api_slots = threading.BoundedSemaphore(max(1, max_concurrent_requests))  # Recreated by main() from max_concurrent_requests
+
+def estimate_image_tokens(width, height):
+    """Approximate input tokens for an image (the API downscales anything above ~1600 tokens)"""
+    return min(1600, (width * height + 749) // 750)
 
+def estimate_input_tokens(images, text="", documents=()):
+    """Approximate input tokens for a request made of the given images, text and native PDF documents"""
+    return (sum(estimate_image_tokens(*image_size(img)) for img in images) + len(text) // 4
+            + sum(document["pages"] for document in documents) * pdf_page_tokens)
+
+def grading_request_params(message_content, max_tokens=4000, tool=None, followup_messages=(), model=None):
+    """Build the messages.create parameters for one grading request"""
+    params = {
+        "model": model or grading_model,
+        "max_tokens": max_tokens,
+        "temperature": 0,
+        "system": system_prompt,
+        "messages": [
+            {"role": "user", "content": message_content}
+        ] + list(followup_messages)
+    }
+    if tool is not None:
+        # Force the tool so the answer is always structured
+        params["tools"] = [tool]
+        params["tool_choice"] = {"type": "tool", "name": tool["name"]}
+    return params
+
+def beta_headers():
+    """Extra headers for requests that use beta API features"""
+    return {"anthropic-beta": files_api_beta} if upload_reference_files else {}
+
+def payload_bytes(message_content):
+    """Approximate request size: base64 image data plus text"""
+    return sum(len(block.get("source", {}).get("data", "")) + len(block.get("text", "")) for block in message_content)
+
+def create_message(message_content, estimated_tokens, student_identifier=None, max_tokens=4000, tool=None, followup_messages=(), model=None):
+    """Call the Messages API through the shared rate limiter, retrying on rate limits and transient errors"""
+    for attempt in range(max_retries):
+        with run_metrics.timed("rate_limit_wait"):
+            rate_limiter.acquire(estimated_tokens)
+        try:
+            print(f"API attempt {attempt+1}/{max_retries}...")
+            run_metrics.count("api_attempts")
+            with api_slots, run_metrics.timed("messages_create"):
+                raw_response = anthropic_client.messages.with_raw_response.create(**grading_request_params(message_content, max_tokens, tool, followup_messages, model), extra_headers=beta_headers())
+            rate_limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+            run_metrics.record_usage(student_identifier, response.usage)
+            return response
+        except (APIStatusError, APIConnectionError) as e:
+            status_code = getattr(e, "status_code", None)
+            headers = e.response.headers if getattr(e, "response", None) is not None else {}
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+            if not retryable or attempt == max_retries - 1:
+                raise
+            
+            # Prefer the server's retry-after; otherwise fall back to exponential backoff with jitter
+            retry_after = _header_float(headers, "retry-after")
+            delay = retry_after if retry_after is not None else base_delay * (2 ** attempt) + random.uniform(1, 5)
+            if status_code == 429 or status_code == 529:
+                # Rate limited or overloaded: the whole pool waits, not just this worker
+                print(f"Rate limit hit ({status_code}). Retrying in {delay:.2f} seconds...")
+                run_metrics.count("rate_limited")
+                rate_limiter.update_from_headers(headers)
+                rate_limiter.backoff(delay)
+            else:
+                print(f"Transient API error ({status_code or 'connection'}). Retrying in {delay:.2f} seconds...")
+                run_metrics.count("transient_errors")
+                with run_metrics.timed("retry_sleep"):
+                    time.sleep(delay)
+
+def _render_size(pdf_info, dpi, max_size):
+    """Pick the poppler scale-to size so pages come out no larger than max_size, or None if dpi already fits"""
+    try:
+        # pdfinfo reports the first page as e.g. "612 x 792 pts (letter)"
+        width_pts, _, height_pts = pdf_info["Page size"].split()[:3]
+        width = float(width_pts) * dpi / 72
+        height = float(height_pts) * dpi / 72
+        if width <= max_size[0] and height <= max_size[1]:
+            return None
+    except (KeyError, ValueError):
+        pass
+    return min(max_size)
+
+def iter_pdf_pages(pdf_path, dpi=100, max_pages=None, max_size=(800, 800)):
+    """Render a PDF one page at a time, already scaled to fit max_size, stopping after max_pages"""
+    pdf_info = pdfinfo_from_path(pdf_path)
+    page_count = int(pdf_info.get("Pages", 0))
+    if max_pages and page_count > max_pages:
+        print(f"PDF has {page_count} pages, limiting to first {max_pages} pages")
+        page_count = max_pages
+    
+    # Let poppler render straight to the target size instead of rendering at full dpi and thumbnailing
+    size = _render_size(pdf_info, dpi, max_size)
+    for page_number in range(1, page_count + 1):
+        pages = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number, size=size)
+        if pages:
+            yield pages[0]
+
+@timed_stage("compress_image")
 def compress_image(image, quality=40, max_size=(800, 800)):
     """Compress and resize an image to reduce file size"""
+    if clean_scans:
+        # Crop away margins at the scale the whole page would have been sent at, so cropping saves pixels
+        scale = min(1.0, max_size[0] / image.width, max_size[1] / image.height)
+        image = crop_to_content(to_grayscale(image))
+        if scale < 1:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+        return normalize_contrast(image)
+    
     # Resize if needed
     if image.width > max_size[0] or image.height > max_size[1]:
         image.thumbnail(max_size, Image.LANCZOS)
     
     return image
 
-def image_to_base64(image, format="JPEG", quality=40):
-    """Convert PIL Image to base64 string with compression"""
-    buffered = BytesIO()
-    image.save(buffered, format=format, quality=quality, optimize=True)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+def to_grayscale(image):
+    """Convert to grayscale, putting any transparent areas on white paper"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        paper = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(paper, image)
+    return image.convert("L")
+
+def _bright_span(fractions, threshold=0.5):
+    """First and last index where a row/column profile exceeds threshold, or None"""
+    indices = np.flatnonzero(fractions > threshold)
+    if indices.size == 0:
+        return None
+    return int(indices[0]), int(indices[-1]) + 1
+
+@timed_stage("crop_to_content")
+def crop_to_content(image, work_size=1000):
+    """Crop a grayscale page to the written area, dropping dark desk margins around photos and blank paper"""
+    # Find the bounding boxes on a reduced copy; only the final crop touches the full-size image
+    factor = max(1, max(image.size) // work_size)
+    small = np.asarray(image.reduce(factor) if factor > 1 else image, dtype=np.int16)
+    height, width = small.shape
+    
+    # Paper: rows and columns that are mostly brighter than the midpoint between the darkest and brightest tones
+    low, high = np.percentile(small, [2, 98])
+    if high - low < ink_contrast:
+        return image
+    paper = small > (low + high) / 2
+    rows = _bright_span(paper.mean(axis=1))
+    cols = _bright_span(paper.mean(axis=0))
+    if rows is None or cols is None:
+        return image
+    top, bottom = rows
+    left, right = cols
+    
+    # Ink: pixels clearly darker than the paper around them, looking only inside the paper area
+    ink = flatten_background(small[top:bottom, left:right]) < 1 - ink_contrast / 255
+    ink_rows = _bright_span(ink.mean(axis=1), threshold=0.002)
+    ink_cols = _bright_span(ink.mean(axis=0), threshold=0.002)
+    if ink_rows is None or ink_cols is None:
+        return image
+    
+    pad = int(crop_padding * max(height, width))
+    box = (max(left, left + ink_cols[0] - pad), max(top, top + ink_rows[0] - pad),
+           min(right, left + ink_cols[1] + pad), min(bottom, top + ink_rows[1] + pad))
+    if box == (0, 0, width, height):
+        return image
+    return image.crop(tuple(coord * factor for coord in box))
+
+def flatten_background(pixels, block=32):
+    """Divide out the local paper brightness (uneven lighting, shadows), leaving paper near 1.0 and ink below it"""
+    pixels = np.asarray(pixels, dtype=np.float32)
+    height, width = pixels.shape
+    # Ink is a minority of each block, so a high percentile per block is the paper brightness there
+    grid_h, grid_w = max(1, height // block), max(1, width // block)
+    block_h, block_w = height // grid_h, width // grid_w
+    blocks = pixels[:grid_h * block_h, :grid_w * block_w].reshape(grid_h, block_h, grid_w, block_w)
+    paper = np.percentile(blocks, 90, axis=(1, 3)).astype(np.float32)
+    paper = np.asarray(Image.fromarray(paper).resize((width, height), Image.BILINEAR))
+    return pixels / np.maximum(paper, 1)
+
+@timed_stage("normalize_contrast")
+def normalize_contrast(image):
+    """Flatten uneven lighting and stretch contrast so the paper is white and the ink is dark (or binarize)"""
+    flattened = flatten_background(image)
+    
+    # Paper texture and noise go to white: cut off at least three robust standard deviations below the paper
+    paper_level = np.median(flattened)
+    spread = 1.4826 * np.median(np.abs(flattened - paper_level))
+    paper_cutoff = min(1 - ink_contrast / 255, paper_level - 3 * spread)
+    # Stretch so the darkest ink goes to black. The ink level comes from the ink pixels alone, since a
+    # whole-page percentile lands on paper when a page holds only a line or two of writing
+    ink = flattened[flattened < paper_cutoff]
+    if ink.size == 0:
+        return image
+    ink_level = np.percentile(ink, 5)
+    stretched = np.clip((flattened - ink_level) / (paper_cutoff - ink_level), 0, 1)
+    if binarize_scans:
+        return Image.fromarray(np.where(stretched < 0.5, 0, 255).astype(np.uint8))
+    return Image.fromarray((stretched * 255).round().astype(np.uint8))
+
+@timed_stage("encode_jpeg")
+def encode_jpeg(image, quality=40):
+    """Encode a PIL Image as compressed JPEG bytes"""
+    # JPEG has no alpha or palette modes (e.g. RGBA or P screenshots saved as PNG)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return buffered.getvalue()
+
+@timed_stage("image_to_base64")
+def image_to_base64(image, format="JPEG", quality=40):
+    """Convert PIL Image (or already-encoded JPEG bytes) to base64 string with compression"""
+    if isinstance(image, bytes):
+        return base64.b64encode(image).decode('utf-8')
+    if format == "JPEG":
+        return base64.b64encode(encode_jpeg(image, quality)).decode('utf-8')
+    buffered = BytesIO()
+    image.save(buffered, format=format, quality=quality, optimize=True)
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+def image_size(image):
+    """Width and height of a PIL Image or of encoded image bytes (reads only the header)"""
+    if isinstance(image, bytes):
+        with Image.open(BytesIO(image)) as img:
+            return img.size
+    return image.width, image.height
+
+def page_pipeline_settings():
+    """Settings that change which student pages are uploaded, beyond the per-file render settings"""
+    return {
+        "drop_blank_pages": drop_blank_pages,
+        "drop_duplicate_pages": drop_duplicate_pages,
+        "blank_ink_coverage": blank_ink_coverage,
+        "ink_contrast": ink_contrast,
+        "duplicate_hash_distance": duplicate_hash_distance,
+        "duplicate_pixel_difference": duplicate_pixel_difference,
+        "clean_scans": clean_scans,
+        "binarize_scans": binarize_scans,
+        "crop_padding": crop_padding,
+        "request_token_budget": request_token_budget,
+        "request_byte_budget": request_byte_budget,
+        "min_page_side": min_page_side,
+        "min_jpeg_quality": min_jpeg_quality,
+        "send_native_pdfs": send_native_pdfs,
+        "native_pdf_max_pages": native_pdf_max_pages,
+        "native_pdf_max_bytes": native_pdf_max_bytes
+    }
+
+def page_cache_key(path, dpi, max_size, quality, max_pages=None):
+    """Cache key for a file's pages rendered with the given settings"""
+    settings = f"dpi={dpi};max_size={max_size[0]}x{max_size[1]};quality={quality};max_pages={max_pages}"
+    if not path.lower().endswith('.pdf'):
+        settings += ";draft_decode;exif_transpose"
+    if clean_scans:
+        settings += f";clean_scans;binarize={binarize_scans};crop_padding={crop_padding};ink_contrast={ink_contrast}"
+    return hashlib.sha256(f"{file_sha256(path)};{settings}".encode('utf-8')).hexdigest()
+
+def load_cached_pages(cache_key):
+    """Load a cached list of JPEG pages, or None on a miss"""
+    entry_dir = os.path.join(page_cache_dir, cache_key)
+    try:
+        page_files = sorted(os.listdir(entry_dir))
+        pages = []
+        for page_file in page_files:
+            with open(os.path.join(entry_dir, page_file), 'rb') as f:
+                pages.append(f.read())
+        # Touch the entry so eviction sees it as recently used
+        os.utime(entry_dir)
+        return pages
+    except OSError:
+        return None
+
+def save_cached_pages(cache_key, pages):
+    """Store JPEG pages in the page cache"""
+    entry_dir = os.path.join(page_cache_dir, cache_key)
+    tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for i, page in enumerate(pages):
+        with open(os.path.join(tmp_dir, f"{i+1:04d}.jpg"), 'wb') as f:
+            f.write(page)
+    try:
+        # Rename is atomic, so readers never see a half-written entry
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another worker stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def evict_page_cache(max_bytes=None):
+    """Delete least recently used page cache entries until the cache fits in max_bytes"""
+    max_bytes = page_cache_max_bytes if max_bytes is None else max_bytes
+    if not os.path.isdir(page_cache_dir):
+        return
+    
+    entries = []
+    total_bytes = 0
+    for entry in os.scandir(page_cache_dir):
+        if entry.is_dir() and not entry.name.endswith('.tmp'):
+            entry_bytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, entry_bytes, entry.path))
+            total_bytes += entry_bytes
+    
+    for _, entry_bytes, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= entry_bytes
+
+def load_pages(path, dpi=100, max_size=(800, 800), quality=40, max_pages=None):
+    """Load a PDF or image file as a list of compressed JPEG pages, using the on-disk page cache"""
+    cache_key = page_cache_key(path, dpi, max_size, quality, max_pages)
+    pages = load_cached_pages(cache_key)
+    if pages is not None:
+        run_metrics.count("page_cache_hits")
+        return pages
+    run_metrics.count("page_cache_misses")
+    
+    if path.lower().endswith('.pdf'):
+        print(f"Converting PDF to images: {path}")
+        pages = []
+        rendering_seconds = 0.0
+        try:
+            # Encode each page as soon as it's rendered, so only one full-size page is held at a time
+            rendered = iter_pdf_pages(path, dpi=dpi, max_pages=max_pages, max_size=max_size)
+            while True:
+                # Only poppler's rendering counts toward pdf_to_images; compress_image and encode_jpeg time themselves
+                start = time.perf_counter()
+                img = next(rendered, None)
+                rendering_seconds += time.perf_counter() - start
+                if img is None:
+                    break
+                pages.append(encode_jpeg(compress_image(img, max_size=max_size), quality))
+        except Exception as e:
+            print(f"Error converting PDF to images: {str(e)}")
+            pages = []
+        finally:
+            run_metrics.record("pdf_to_images", rendering_seconds)
+    else:
+        pages = [encode_jpeg(compress_image(load_image(path, max_size), max_size=max_size), quality)]
+    
+    # An empty result means rasterization failed; don't remember that
+    if pages:
+        save_cached_pages(cache_key, pages)
+    return pages
+
+@timed_stage("load_image")
+def load_image(path, max_size=(800, 800)):
+    """Open a photo or scan decoded at the smallest scale that still covers max_size, turned upright, with the file closed"""
+    with Image.open(path) as img:
+        # JPEGs decode directly at 1/2, 1/4 or 1/8 scale (and grayscale-only when scans are cleaned);
+        # ask for at least the size the long side is shrunk to, whichever way the photo is turned
+        scale = min(1.0, max(max_size) / max(img.size))
+        img.draft("L" if clean_scans else "RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        # Phones store photos sideways and record the rotation in EXIF
+        image = ImageOps.exif_transpose(img)
+        image.load()
+    return image
+
+def image_block(image):
+    """Build a base64 JPEG image content block"""
+    return {
+        "type": "image", 
+        "source": {
+            "type": "base64", 
+            "media_type": "image/jpeg", 
+            "data": image_to_base64(image)
+        }
+    }
+
+def _dct_matrix(size):
+    """Orthogonal DCT-II basis, for perceptual hashing without scipy"""
+    k = np.arange(size)
+    return np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size))
+
+def page_signatures(pages, size=256, hash_size=8):
+    """Decode pages as small grayscale arrays plus perceptual hashes, stacked for vectorized checks"""
+    thumbnails = []
+    aspects = []
+    for page in pages:
+        img = Image.open(BytesIO(page)) if isinstance(page, bytes) else page
+        aspects.append(img.width / img.height)
+        # For JPEG bytes, decode at a reduced DCT scale; only a thumbnail is needed
+        img.draft('L', (size * 2, size * 2))
+        thumbnails.append(np.asarray(img.convert('L').resize((size, size), Image.BOX), dtype=np.float32))
+    thumbnails = np.stack(thumbnails)
+    
+    # pHash: low-frequency DCT coefficients of a 32x32 version, each compared with their median (DC term skipped)
+    n = len(pages)
+    small = thumbnails.reshape(n, 32, size // 32, 32, size // 32).mean(axis=(2, 4))
+    dct = _dct_matrix(32)
+    coefficients = (dct @ small @ dct.T)[:, :hash_size, :hash_size].reshape(n, -1)[:, 1:]
+    bits = coefficients > np.median(coefficients, axis=1)[:, None]
+    return thumbnails, bits, np.asarray(aspects)
+
+def inner_ink(thumbnails, margin=0.05):
+    """Inner region of each thumbnail (scanner edges cut off) and its ink mask"""
+    n, height, width = thumbnails.shape
+    margin_y, margin_x = int(height * margin), int(width * margin)
+    inner = thumbnails[:, margin_y:height - margin_y, margin_x:width - margin_x].reshape(n, -1).astype(np.float32, copy=False)
+    # Paper is the dominant tone of a page, so its median is the background level
+    background = np.median(inner, axis=1)
+    return inner, inner < (background - ink_contrast)[:, None]
+
+def ink_coverage(thumbnails):
+    """Fraction of each page that is ink, ignoring scanner edges"""
+    return inner_ink(thumbnails)[1].mean(axis=1)
+
+def page_matches(signatures, other_signatures):
+    """Pairwise near-duplicate matrix for two sets of (thumbnails, hash bits, aspect ratios) page signatures"""
+    thumbnails, bits, aspects = signatures
+    other_thumbnails, other_bits, other_aspects = other_signatures
+    # Candidates have a close perceptual hash and the same shape
+    distances = (bits[:, None, :] != other_bits[None, :, :]).sum(axis=2)
+    same_shape = np.abs(aspects[:, None] - other_aspects[None, :]) < 0.1
+    matches = (distances <= duplicate_hash_distance) & same_shape
+    
+    # Confirm each candidate pixel by pixel: sparse handwritten pages can share a hash while the writing differs
+    inner, ink = inner_ink(thumbnails)
+    other_inner, other_ink = inner_ink(other_thumbnails)
+    for i, j in zip(*np.nonzero(matches)):
+        written = ink[i] | other_ink[j]
+        difference = np.abs(inner[i][written] - other_inner[j][written]).mean() if written.any() else 0.0
+        matches[i, j] = difference <= duplicate_pixel_difference
+    return matches
+
+def ink_overlaps(ink, other_ink):
+    """Whether every page shares at least near_identical_ink_overlap of its combined ink with the other page (packed ink masks)"""
+    shared = np.unpackbits(ink & other_ink, axis=1).sum(axis=1)
+    combined = np.unpackbits(ink | other_ink, axis=1).sum(axis=1)
+    return bool(np.all(shared >= near_identical_ink_overlap * combined))
+
+@timed_stage("filter_pages")
+def filter_pages(pages):
+    """Drop near-blank pages and near-duplicate pages (e.g. the same sheet uploaded as a PDF and a photo)"""
+    if not pages or not (drop_blank_pages or drop_duplicate_pages):
+        return pages
+    
+    thumbnails, bits, aspects = page_signatures(pages)
+    coverage = ink_coverage(thumbnails)
+    keep = np.ones(len(pages), dtype=bool)
+    
+    if drop_blank_pages:
+        keep &= coverage >= blank_ink_coverage
+    blank_count = int((~keep).sum())
+    
+    duplicate_count = 0
+    if drop_duplicate_pages:
+        # A page is a duplicate of an earlier kept page that it matches
+        signatures = (thumbnails, bits, aspects)
+        matches = page_matches(signatures, signatures)
+        for i in range(len(pages)):
+            if keep[i] and np.any(keep[:i] & matches[i, :i]):
+                keep[i] = False
+                duplicate_count += 1
+    
+    # Never send an empty submission; let the grader see an all-blank upload as it is
+    if not keep.any():
+        return pages
+    
+    if blank_count or duplicate_count:
+        print(f"Dropped {blank_count} blank and {duplicate_count} duplicate pages out of {len(pages)}")
+        run_metrics.count("blank_pages_dropped", blank_count)
+        run_metrics.count("duplicate_pages_dropped", duplicate_count)
+    return [page for page, kept in zip(pages, keep) if kept]
+
+def reencode_page(page, size, quality):
+    """Re-encode a JPEG page at a smaller size and/or different quality"""
+    with Image.open(BytesIO(page)) as img:
+        # Let the JPEG decoder do most of the downscaling
+        img.draft(img.mode, size)
+        img = img.convert('L' if img.mode == 'L' else 'RGB')
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        return encode_jpeg(img, quality)
+
+def page_budget_for(reference_images):
+    """Token and byte budget left for student pages once the prompt and reference pages are counted"""
+    reference_bytes = payload_bytes(reference_images['content'])
+    return (request_token_budget - reference_images['estimated_tokens'], request_byte_budget - reference_bytes)
+
+@timed_stage("fit_pages_to_budget")
+def fit_pages_to_budget(pages, token_budget, byte_budget, quality=40):
+    """Shrink pages to fit a token and byte budget, giving dense handwritten pages more resolution than sparse ones"""
+    sizes = [image_size(page) for page in pages]
+    full_tokens = np.array([estimate_image_tokens(width, height) for width, height in sizes], dtype=float)
+    total_bytes = sum(len(page) for page in pages) * 4 / 3  # base64
+    if not pages or (full_tokens.sum() <= token_budget and total_bytes <= byte_budget):
+        return pages
+    
+    # Dense pages get a bigger share of the budget; the square root keeps sparse pages from being starved
+    thumbnails, _, _ = page_signatures(pages)
+    coverage = ink_coverage(thumbnails)
+    weights = np.sqrt(np.maximum(coverage, blank_ink_coverage))
+    floor_tokens = np.array([estimate_image_tokens(*_scaled_size(width, height, min_page_side / max(width, height)))
+                             for width, height in sizes], dtype=float)
+    floor_tokens = np.minimum(floor_tokens, full_tokens)
+    
+    # Water-filling: find the share per unit weight so the clipped allocations add up to the budget
+    low, high = 0.0, float(full_tokens.max() / weights.min())
+    for _ in range(50):
+        share = (low + high) / 2
+        if np.clip(share * weights, floor_tokens, full_tokens).sum() > token_budget:
+            high = share
+        else:
+            low = share
+    target_tokens = np.clip(low * weights, floor_tokens, full_tokens)
+    if floor_tokens.sum() > token_budget:
+        print(f"Warning: {len(pages)} pages need at least {int(floor_tokens.sum())} tokens, over the budget of {int(token_budget)}")
+    
+    # Sparse pages also get a lower JPEG quality
+    qualities = np.where(coverage >= np.median(coverage), quality, max(min_jpeg_quality, quality - 10)).astype(int)
+    scales = np.sqrt(target_tokens / full_tokens)
+    while True:
+        fitted = []
+        for page, (width, height), scale, page_quality in zip(pages, sizes, scales, qualities):
+            if scale > 0.98 and page_quality == quality:
+                fitted.append(page)
+            else:
+                fitted.append(reencode_page(page, _scaled_size(width, height, scale), int(page_quality)))
+        fitted_bytes = sum(len(page) for page in fitted) * 4 / 3
+        if fitted_bytes <= byte_budget or qualities.max() <= min_jpeg_quality:
+            break
+        # Still too large on the wire: step every page's quality down
+        qualities = np.maximum(min_jpeg_quality, qualities - 5)
+    
+    fitted_sizes = [image_size(page) for page in fitted]
+    print(f"Fitted {len(pages)} pages into the request budget: {int(full_tokens.sum())} -> {int(target_tokens.sum())} image tokens, "
+          f"{int(total_bytes)} -> {int(fitted_bytes)} bytes; long sides {min(max(s) for s in fitted_sizes)}-{max(max(s) for s in fitted_sizes)} px, "
+          f"JPEG quality {int(qualities.min())}-{int(qualities.max())}")
+    run_metrics.count("pages_refitted", len(pages))
+    return fitted
+
+def _scaled_size(width, height, scale):
+    scale = min(1.0, scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def pdf_page_count(path):
+    """Number of pages in a PDF, or None if it can't be read"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Page objects are usually in plain sight; PDFs that pack them into compressed object streams need pdfinfo
+    count = len(re.findall(rb"/Type\s*/Page(?![a-zA-Z])", data))
+    if count:
+        return count
+    try:
+        return pdfinfo_from_path(path)["Pages"]
+    except Exception:
+        return None
+
+def load_native_pdf(path):
+    """A student PDF as a document to send natively, or None if it should be rasterized instead"""
+    size = os.path.getsize(path)
+    if size > native_pdf_max_bytes:
+        return None
+    page_count = pdf_page_count(path)
+    if not page_count or page_count > native_pdf_max_pages:
+        return None
+    with open(path, 'rb') as f:
+        data = base64.b64encode(f.read()).decode('utf-8')
+    return {"filename": os.path.basename(path), "data": data, "pages": page_count}
+
+def pdf_document_block(data):
+    """Build a document content block for a base64-encoded PDF"""
+    return {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": data}}
+
+def file_document_block(file_id):
+    """Build a document content block for a file uploaded through the Files API"""
+    return {"type": "document", "source": {"type": "file", "file_id": file_id}}
+
+def upload_reference_file(path):
+    """Upload a PDF through the Files API once, reusing the stored file_id while the file is unchanged and still on the server"""
+    digest = file_sha256(path)
+    try:
+        with open(reference_files_path, 'r') as f:
+            uploaded = json.load(f)
+    except (OSError, ValueError):
+        uploaded = {}
+    
+    file_id = uploaded.get(digest)
+    if file_id:
+        try:
+            anthropic_client.beta.files.retrieve_metadata(file_id)
+            print(f"Using uploaded file {file_id} for {path}")
+            return file_id
+        except NotFoundError:
+            print(f"Uploaded file {file_id} for {path} no longer exists, uploading again")
+    
+    with open(path, 'rb') as f, run_metrics.timed("upload_reference_file"):
+        file_id = anthropic_client.beta.files.upload(file=(os.path.basename(path), f, "application/pdf")).id
+    print(f"Uploaded {path} as {file_id}")
+    uploaded[digest] = file_id
+    os.makedirs(os.path.dirname(reference_files_path) or ".", exist_ok=True)
+    tmp_path = f"{reference_files_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(uploaded, f, indent=2)
+    os.replace(tmp_path, reference_files_path)
+    return file_id
+
+def prepare_reference_images():
+    """Prepare reference images that combine both question and solution PDFs"""
+    print("Preparing reference images (question and solution)...")
+    
+    # Convert question PDF to images
+    question_images = load_pages(question_path, dpi=100)
+    print(f"Processed question PDF with {len(question_images)} pages")
+    
+    # Convert solution PDF to images
+    solution_images = load_pages(solution_path, dpi=100)
+    print(f"Processed solution PDF with {len(solution_images)} pages")
+    
+    # Build the prompt plus question/solution pages once; every request reuses this prefix unchanged
+    content = [{"type": "text", "text": grading_prompt}]
+    if upload_reference_files:
+        # The PDFs are uploaded once and referenced by ID, so requests carry only the student's pages
+        content.append({"type": "text", "text": "QUESTION PDF:"})
+        content.append(file_document_block(upload_reference_file(question_path)))
+        content.append({"type": "text", "text": "SOLUTION PDF:"})
+        content.append(file_document_block(upload_reference_file(solution_path)))
+        estimated_tokens = (len(question_images) + len(solution_images)) * pdf_page_tokens + len(grading_prompt + system_prompt) // 4
+    else:
+        for i, img in enumerate(question_images):
+            content.append({"type": "text", "text": f"QUESTION PAGE {i+1}:"})
+            content.append(image_block(img))
+        for i, img in enumerate(solution_images):
+            content.append({"type": "text", "text": f"SOLUTION PAGE {i+1}:"})
+            content.append(image_block(img))
+        estimated_tokens = estimate_input_tokens(question_images + solution_images, grading_prompt + system_prompt)
+    
+    # Mark the end of the prefix so the API caches system prompt + reference pages across students
+    content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+    
+    return {
+        'question_images': question_images,
+        'solution_images': solution_images,
+        'content': tuple(content),
+        'estimated_tokens': estimated_tokens
+    }
+
+def build_message_content(student_images, reference_images, student_documents=()):
+    """Build the user message: the pre-encoded prompt and reference pages, then the student's documents and pages"""
+    message_content = list(reference_images['content'])
+    message_content.append({
+        "type": "text",
+        "text": "STUDENT SUBMISSION:"
+    })
+    
+    for document in student_documents:
+        message_content.append({
+            "type": "text",
+            "text": f"STUDENT PDF {document['filename']} ({document['pages']} pages):"
+        })
+        message_content.append(pdf_document_block(document['data']))
+    
+    for i, img in enumerate(student_images):
+        message_content.append({
+            "type": "text",
+            "text": f"STUDENT PAGE {i+1}:"
+        })
+        message_content.append(image_block(img))
+    
+    # A second breakpoint after the student's pages lets follow-up turns and retries read them from the cache
+    if cache_student_pages:
+        message_content[-1] = dict(message_content[-1], cache_control={"type": "ephemeral"})
+    
+    return message_content
+
+def parse_grading_response(response_text):
+    """Extract the grading JSON from Claude's response text"""
+    # Find JSON in the response (in case Claude adds any text before/after)
+    json_start = response_text.find('{')
+    json_end = response_text.rfind('}') + 1
+    if json_start >= 0 and json_end > json_start:
+        return json.loads(response_text[json_start:json_end])
+    raise ValueError("No JSON found in the response")
+
+def grading_from_message(message):
+    """The grading in a response: the record_grades tool input, or JSON found in the text"""
+    for block in message.content:
+        if block.type == "tool_use" and block.name == grading_tool["name"]:
+            grading_result, raw_response = block.input, json.dumps(block.input)
+            break
+    else:
+        raw_response = "".join(block.text for block in message.content if block.type == "text")
+        grading_result = parse_grading_response(raw_response)
+    if not isinstance(grading_result, dict):
+        raise ValueError("grading is not a JSON object")
+    return dict(grading_result), raw_response
+
+def check_grading(grading_result):
+    """Split a grading into valid problems by number and the problem numbers that are missing or invalid"""
+    valid = {}
+    invalid = set()
+    for problem in grading_result.get("problems", []):
+        try:
+            problem_number = int(problem["problem_number"])
+            score = problem["score"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not 1 <= problem_number <= problem_count:
+            continue
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= problem_max_score or problem_number in valid:
+            invalid.add(problem_number)
+            continue
+        valid[problem_number] = dict(problem, problem_number=problem_number, max_score=problem_max_score)
+    for problem_number in invalid:
+        valid.pop(problem_number, None)
+    missing = [problem_number for problem_number in range(1, problem_count + 1) if problem_number not in valid]
+    return valid, missing
+
+def followup_turns(message, missing):
+    """The assistant's answer plus a user turn asking again for only the missing or invalid problems"""
+    request = (f"Problem(s) {', '.join(str(number) for number in missing)} are missing or invalid in that grading "
+               f"(each needs a problem_number, a score from 0 to {problem_max_score} and max_score {problem_max_score}). "
+               f"Call {grading_tool['name']} again with only these problems.")
+    tool_use = next((block for block in message.content if block.type == "tool_use"), None)
+    if tool_use is not None:
+        return [
+            {"role": "assistant", "content": [{"type": "tool_use", "id": tool_use.id, "name": tool_use.name, "input": tool_use.input}]},
+            {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_use.id, "is_error": True, "content": request}]}
+        ]
+    text = "".join(block.text for block in message.content if block.type == "text") or "(no answer)"
+    return [
+        {"role": "assistant", "content": [{"type": "text", "text": text}]},
+        {"role": "user", "content": [{"type": "text", "text": request}]}
+    ]
+
+def complete_grading(message_content, estimated_tokens, response, student_identifier, model=None, tool=None):
+    """Validate a grading and ask follow-up questions for just the missing or invalid problems; returns (result, raw text)"""
+    try:
+        grading_result, raw_response = grading_from_message(response)
+    except (ValueError, TypeError) as e:
+        print(f"Could not parse the grading for student {student_identifier} ({str(e)}), asking again")
+        grading_result, raw_response = {}, None
+    valid, missing = check_grading(grading_result)
+    followup_messages = []
+    for _ in range(max_grading_followups):
+        if not missing:
+            break
+        print(f"Asking again for problem(s) {missing} of student {student_identifier}")
+        run_metrics.count("grading_followups")
+        followup_messages += followup_turns(response, missing)
+        response = create_message(message_content, estimated_tokens, student_identifier, max_tokens=1500,
+                                  tool=tool or grading_tool, followup_messages=followup_messages, model=model)
+        try:
+            followup_result, followup_raw = grading_from_message(response)
+        except (ValueError, TypeError):
+            continue
+        raw_response = followup_raw if raw_response is None else f"{raw_response}\n{followup_raw}"
+        followup_valid, _ = check_grading(followup_result)
+        valid.update((number, problem) for number, problem in followup_valid.items() if number in missing)
+        missing = [number for number in missing if number not in valid]
+    if missing:
+        raise ValueError(f"no valid grade for problem(s) {missing} after {max_grading_followups} follow-ups")
+    
+    # The per-problem scores are what gets reported, so the total is always recomputed from them
+    problems = [valid[number] for number in sorted(valid)]
+    overall_score = sum(problem["score"] for problem in problems)
+    if grading_result.get("overall_score") != overall_score:
+        run_metrics.count("overall_score_fixed")
+    return {
+        "problems": problems,
+        "overall_score": overall_score,
+        "overall_max": problem_count * problem_max_score,
+        "overall_feedback": grading_result.get("overall_feedback", "")
+    }, raw_response
+
+def escalation_reasons(grading_result):
+    """Why a screening grade should be redone by grading_model (empty if it can be kept)"""
+    reasons = []
+    low, high = escalation_score_band
+    for problem in grading_result["problems"]:
+        confidence = problem.get("confidence")
+        if isinstance(confidence, bool) or not isinstance(confidence, (int, float)) or confidence < escalation_confidence:
+            reasons.append(f"problem {problem['problem_number']} confidence {confidence}")
+        elif low <= problem["score"] / problem_max_score <= high:
+            reasons.append(f"problem {problem['problem_number']} scored {problem['score']}")
+    return reasons
+
+def grade_message(message_content, estimated_tokens, student_identifier):
+    """Grade a prepared request, screening it with the cheaper model first in cascade mode; returns (result, raw text, model)"""
+    if use_model_cascade:
+        response = create_message(message_content, estimated_tokens, student_identifier, model=screening_model, tool=screening_tool)
+        try:
+            grading_result, raw_response = complete_grading(message_content, estimated_tokens, response, student_identifier,
+                                                            model=screening_model, tool=screening_tool)
+            reasons = escalation_reasons(grading_result)
+        except ValueError as e:
+            reasons = [str(e)]
+        if not reasons:
+            run_metrics.count("cascade_accepted")
+            # The kept grade has the same fields as one from grading_model
+            for problem in grading_result["problems"]:
+                problem.pop("confidence", None)
+            return grading_result, raw_response, screening_model
+        print(f"Regrading student {student_identifier} with {grading_model}: {'; '.join(reasons)}")
+        run_metrics.count("cascade_escalations")
+    
+    response = create_message(message_content, estimated_tokens, student_identifier, tool=grading_tool)
+    grading_result, raw_response = complete_grading(message_content, estimated_tokens, response, student_identifier)
+    return grading_result, raw_response, grading_model
+
+def process_submission(submission_path, student_identifier, reference_images=None):
+    """Process a single student submission"""
+    if reference_images is None:
+        reference_images = prepare_reference_images()
+    document = load_native_pdf(submission_path) if send_native_pdfs and submission_path.lower().endswith('.pdf') else None
+    if document:
+        return process_submission_with_images([], student_identifier, reference_images, student_documents=[document])
+    
+    # Convert student submission to images
+    if submission_path.lower().endswith('.pdf'):
+        student_images = load_pages(submission_path, dpi=100)
+        print(f"Processed student submission with {len(student_images)} pages")
+    else:
+        # If it's already an image file, just load it
+        try:
+            student_images = load_pages(submission_path)
+        except Exception as e:
+            print(f"Error loading image file: {str(e)}")
+            return {
+                "problems": [],
+                "overall_score": 0,
+                "overall_max": problem_count * problem_max_score,
+                "overall_feedback": f"Error loading image file: {str(e)}",
+                "error": True
+            }
+    
+    student_images = filter_pages(student_images)
+    student_images = fit_pages_to_budget(student_images, *page_budget_for(reference_images))
+    return process_submission_with_images(student_images, student_identifier, reference_images)
+
+def index_pages(pages, label, student_identifier=None):
+    """Ask which problems appear on each page; returns {problem_number: [page indexes]}, or None if that fails"""
+    content = [{"type": "text", "text": page_index_prompt}]
+    thumbnails = []
+    for i, page in enumerate(pages):
+        width, height = image_size(page)
+        thumbnail = reencode_page(page, _scaled_size(width, height, index_page_scale), 40)
+        thumbnails.append(thumbnail)
+        content.append({"type": "text", "text": f"PAGE {i+1}:"})
+        content.append(image_block(thumbnail))
+    
+    try:
+        with run_metrics.timed("index_pages"):
+            response = create_message(content, estimate_input_tokens(thumbnails, page_index_prompt + system_prompt),
+                                      student_identifier, max_tokens=1000)
+        page_entries = parse_grading_response(response.content[0].text)["pages"]
+        page_index = {problem_number: [] for problem_number in range(1, problem_count + 1)}
+        for entry in page_entries:
+            page_number = int(entry["page"])
+            if not 1 <= page_number <= len(pages):
+                continue
+            for problem_number in entry.get("problems", []):
+                if int(problem_number) in page_index:
+                    page_index[int(problem_number)].append(page_number - 1)
+    except Exception as e:
+        print(f"Could not index {label} pages, sending all of them for every problem: {str(e)}")
+        return None
+    
+    # A problem that wasn't found anywhere gets every page rather than being graded blind
+    for problem_number, page_numbers in page_index.items():
+        if not page_numbers:
+            print(f"Problem {problem_number} not found on any {label} page, sending all pages for it")
+            page_index[problem_number] = list(range(len(pages)))
+    return {problem_number: sorted(set(page_numbers)) for problem_number, page_numbers in page_index.items()}
+
+def pages_for_problem(pages, page_index, problem_number):
+    """The pages of a document that show the given problem (all of them if the document isn't indexed)"""
+    if page_index is None:
+        return pages
+    return [pages[i] for i in page_index[problem_number]]
+
+def prepare_problem_references(reference_images):
+    """Index the question and solution pages and build a cacheable request prefix for each problem"""
+    # The reference index only depends on the reference PDFs, prompt and model, so keep it with the result cache
+    digest = hashlib.sha256()
+    for part in [grading_model, page_index_prompt, file_sha256(question_path), file_sha256(solution_path),
+                 json.dumps(page_pipeline_settings(), sort_keys=True)]:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    index_path = os.path.join(result_cache_dir, f"reference_index_{digest.hexdigest()}.json")
+    try:
+        with open(index_path, 'r') as f:
+            indexes = {name: {int(problem_number): pages for problem_number, pages in page_index.items()}
+                       for name, page_index in json.load(f).items()}
+    except (OSError, ValueError):
+        indexes = {
+            'question': index_pages(reference_images['question_images'], "question"),
+            'solution': index_pages(reference_images['solution_images'], "solution")
+        }
+        if indexes['question'] is not None and indexes['solution'] is not None:
+            os.makedirs(result_cache_dir, exist_ok=True)
+            with open(index_path, 'w') as f:
+                json.dump(indexes, f, indent=2)
+    
+    problems = {}
+    for problem_number in range(1, problem_count + 1):
+        prompt = problem_prompt.format(problem_number=problem_number, **rubric_fields())
+        question_images = pages_for_problem(reference_images['question_images'], indexes['question'], problem_number)
+        solution_images = pages_for_problem(reference_images['solution_images'], indexes['solution'], problem_number)
+        content = [{"type": "text", "text": prompt}]
+        for i, img in enumerate(question_images):
+            content.append({"type": "text", "text": f"QUESTION PAGE {i+1}:"})
+            content.append(image_block(img))
+        for i, img in enumerate(solution_images):
+            content.append({"type": "text", "text": f"SOLUTION PAGE {i+1}:"})
+            content.append(image_block(img))
+        # Each problem's prefix is reused by every student, so it gets its own cache breakpoint
+        content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+        problems[problem_number] = {
+            'content': tuple(content),
+            'estimated_tokens': estimate_input_tokens(question_images + solution_images, prompt + system_prompt)
+        }
+    return problems
+
+def parse_problem_response(response_text, problem_number):
+    """Extract and check one problem's grading JSON"""
+    problem = parse_grading_response(response_text)
+    if int(problem.get("problem_number", problem_number)) != problem_number:
+        raise ValueError(f"response graded problem {problem.get('problem_number')} instead of {problem_number}")
+    score = problem["score"]
+    if not isinstance(score, (int, float)) or not 0 <= score <= problem_max_score:
+        raise ValueError(f"score {score!r} out of range for problem {problem_number}")
+    problem["problem_number"] = problem_number
+    problem["max_score"] = problem_max_score
+    return problem
+
+def grade_problem(problem_number, student_images, problem_reference, student_identifier):
+    """Grade one problem, retrying only this problem when its response is malformed; returns (problem, response text)"""
+    message_content = build_message_content(student_images, problem_reference)
+    estimated_tokens = problem_reference['estimated_tokens'] + estimate_input_tokens(student_images)
+    run_metrics.record_student(student_identifier, payload_bytes=payload_bytes(message_content))
+    for attempt in range(problem_retries + 1):
+        response = create_message(message_content, estimated_tokens, student_identifier, max_tokens=1000)
+        try:
+            return parse_problem_response(response.content[0].text, problem_number), response.content[0].text
+        except (ValueError, KeyError, TypeError) as e:
+            if attempt == problem_retries:
+                raise
+            print(f"Malformed response for problem {problem_number} of {student_identifier} ({str(e)}), asking again")
+            run_metrics.count("problem_retries")
+
+def merge_problem_results(problems, errors):
+    """Combine per-problem gradings into the whole-submission result format"""
+    problems = sorted(problems, key=lambda problem: problem["problem_number"])
+    result = {
+        "problems": problems,
+        "overall_score": sum(problem["score"] for problem in problems),
+        "overall_max": problem_count * problem_max_score
+    }
+    if errors:
+        result["overall_feedback"] = "API error: " + "; ".join(f"problem {number}: {error}" for number, error in sorted(errors.items()))
+        result["error"] = True
+        return result
+    deducted = [str(problem["problem_number"]) for problem in problems if problem["score"] < problem["max_score"]]
+    if deducted:
+        result["overall_feedback"] = f"Marks deducted on problem(s) {', '.join(deducted)}; see the per-problem feedback."
+    else:
+        result["overall_feedback"] = "Full marks on every problem."
+    return result
+
+def process_submission_per_problem(student_images, student_identifier, reference_images, cache_key=None):
+    """Grade a submission one problem at a time, sending each request only the pages for that problem"""
+    print(f"Processing submission for student {student_identifier} problem by problem...")
+    if 'problems' not in reference_images:
+        reference_images['problems'] = prepare_problem_references(reference_images)
+    run_metrics.record_student(student_identifier, pages=len(student_images))
+    
+    # Problems that were graded before (e.g. by a run where another problem failed) come from the cache
+    problems = []
+    errors = {}
+    pending = {}
+    raw_responses = {}
+    for problem_number in range(1, problem_count + 1):
+        problem_cache_key = f"{cache_key}_problem_{problem_number}" if cache_key else None
+        cached_problem = load_cached_result(problem_cache_key) if problem_cache_key else None
+        if cached_problem is not None:
+            problems.append(cached_problem)
+        else:
+            pending[problem_number] = problem_cache_key
+    
+    started = time.perf_counter()
+    page_index = index_pages(student_images, "student", student_identifier) if pending else None
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as problem_executor:
+        futures = {}
+        for problem_number in pending:
+            problem_images = pages_for_problem(student_images, page_index, problem_number)
+            futures[problem_number] = problem_executor.submit(
+                grade_problem, problem_number, problem_images, reference_images['problems'][problem_number], student_identifier)
+        for problem_number, future in futures.items():
+            try:
+                problem, raw_responses[problem_number] = future.result()
+            except Exception as e:
+                print(f"API error for problem {problem_number} of student {student_identifier}: {str(e)}")
+                errors[problem_number] = str(e)
+                continue
+            problems.append(problem)
+            if pending[problem_number]:
+                save_cached_result(pending[problem_number], problem)
+    
+    grading_result = merge_problem_results(problems, errors)
+    if not errors:
+        print(f"Successfully processed submission for student {student_identifier}")
+    if cache_key:
+        save_cached_result(cache_key, grading_result)
+    save_grading_result(student_identifier, grading_result, cache_key, json.dumps(raw_responses) if raw_responses else None,
+                        time.perf_counter() - started)
+    return grading_result
+
+def parse_receipt(txt_path, directory_files=None):
+    """Parse a Blackboard submission receipt (.txt) into a metadata record"""
+    key = os.path.basename(txt_path)[:-len('.txt')]
+    record = {
+        "key": key,
+        "txt_path": txt_path,
+        "name": "Unknown",
+        "student_id": "Unknown",
+        "date_submitted": "Unknown",
+        "attempt": key.split('_attempt_')[-1] if '_attempt_' in key else "Unknown",
+        "original_filename": "Unknown",
+        "filenames": [],
+        "submission_paths": []
+    }
+    
+    with open(txt_path, 'r') as f:
+        lines = f.readlines()
+    
+    in_files_section = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith("Name:"):
+            # Format: "Name: John Doe (jdoe)"
+            name_parts = line.split("(")
+            if len(name_parts) > 1:
+                record["name"] = name_parts[0].replace("Name:", "").strip()
+                record["student_id"] = name_parts[1].replace(")", "").strip()
+        elif line.startswith("Date Submitted:"):
+            record["date_submitted"] = line.replace("Date Submitted:", "").strip()
+        elif line == "Files:":
+            in_files_section = True
+        elif in_files_section and line.startswith("Original filename:"):
+            # Only the first original filename is reported in the CSV
+            if record["original_filename"] == "Unknown":
+                record["original_filename"] = line.replace("Original filename:", "").strip()
+        elif in_files_section and line.startswith("Filename:"):
+            submission_filename = line.replace("Filename:", "").strip()
+            record["filenames"].append(submission_filename)
+            
+            # Keep the gradeable files that are actually present next to the receipt
+            full_submission_path = os.path.join(os.path.dirname(txt_path), submission_filename)
+            file_ext = submission_filename.lower().split('.')[-1] if '.' in submission_filename else ''
+            present = submission_filename in directory_files if directory_files is not None else os.path.exists(full_submission_path)
+            if present and file_ext in supported_extensions:
+                record["submission_paths"].append(full_submission_path)
+    
+    return record
+
+def build_gradebook_index(directory=None):
+    """Walk the gradebook once and index every receipt by its 'Homework 3_<id>_attempt_<ts>' prefix"""
+    directory = directory or student_dir
+    index = {}
+    for root, dirs, files in os.walk(directory):
+        directory_files = set(files)
+        for file in files:
+            if file.endswith('.txt') and file.startswith(receipt_prefix):
+                txt_path = os.path.join(root, file)
+                try:
+                    record = parse_receipt(txt_path, directory_files)
+                except Exception as e:
+                    print(f"Error reading text file {txt_path}: {str(e)}")
+                    continue
+                index[record["key"]] = record
+    return index
+
+def receipt_key(submission_filename):
+    """Get the receipt key ('Homework 3_<id>_attempt_<ts>') for a submission filename"""
+    # The submission filename should be in this format:
+    # "Homework 3_studentid_attempt_timestamp_originalname.pdf"
+    parts = submission_filename.split('_')
+    if len(parts) < 4:
+        return None
+    return f"{parts[0]}_{parts[1]}_{parts[2]}_{parts[3]}"
+
+_gradebook_index = None
+
+_file_digests = {}
+
+def _digest_memo_key(path):
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+def file_sha256(path):
+    """SHA-256 of a file's contents, memoized on path, size and modification time"""
+    memo_key = _digest_memo_key(path)
+    if memo_key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _file_digests[memo_key] = digest.hexdigest()
+    return _file_digests[memo_key]
+
+def grading_cache_key(submission_paths):
+    """Hash the submission bytes, prompts, reference PDFs and model into a result cache key"""
+    digest = hashlib.sha256()
+    # The per-problem prompt is a template, so the rubric it's filled in with goes into the key alongside it
+    prompts = [page_index_prompt, problem_prompt, json.dumps(rubric_fields(), sort_keys=True)] if per_problem_grading else [grading_prompt]
+    # The model sees the references differently as PDF documents than as our page images
+    reference_format = "reference_pdfs" if upload_reference_files and not per_problem_grading else "reference_pages"
+    # A cascade keeps some grades from the screening model, so its settings change the result too
+    cascade = f"cascade:{screening_model}:{escalation_confidence}:{escalation_score_band}" if use_model_cascade else "single_model"
+    for part in [grading_model, system_prompt, reference_format, cascade] + prompts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    # Page filtering decides what the model sees, so its settings are part of the key too
+    digest.update(json.dumps(page_pipeline_settings(), sort_keys=True).encode('utf-8'))
+    for path in [question_path, solution_path] + list(submission_paths):
+        digest.update(file_sha256(path).encode('ascii'))
+    return digest.hexdigest()
+
+def load_cached_result(cache_key):
+    """Load a finished grading result from the cache, or None if it isn't there"""
+    cache_path = os.path.join(result_cache_dir, f"{cache_key}.json")
+    try:
+        with open(cache_path, 'r') as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Error records are never final; grade those students again
+    return None if result.get("error", False) else result
+
+def save_cached_result(cache_key, result):
+    """Store a successful grading result in the cache"""
+    if result.get("error", False):
+        return
+    os.makedirs(result_cache_dir, exist_ok=True)
+    cache_path = os.path.join(result_cache_dir, f"{cache_key}.json")
+    # Write to a temporary file first so a crash never leaves a truncated cache entry
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+def blackboard_feedback(result):
+    """Feedback column: one line per problem that didn't get full marks"""
+    # Format feedback as comma-separated list for questions without full marks
+    feedback_parts = []
+    
+    # Only include feedback for problems that didn't get full marks
+    for problem in result.get("problems", []):
+        if problem.get("score", problem_max_score) < problem.get("max_score", problem_max_score) and "feedback" in problem:
+            feedback_parts.append(f"Q{problem['problem_number']}: {problem.get('feedback', '')}")
+    
+    # Join with commas
+    return ", ".join(feedback_parts)
+
+def blackboard_grade(result):
+    """Grade column: the overall score as a percentage"""
+    if result.get("overall_max", 0) > 0:
+        percentage = (result.get("overall_score", 0) / result.get("overall_max", 100)) * 100
+    else:
+        percentage = 0
+    return f"{percentage:.2f}"
+
+class ResultsStore:
+    """SQLite database of grading results, one row per submission, written in a transaction per student"""
+    
+    columns = ["submission_identifier", "student_id", "name", "date_submitted", "original_filename", "cache_key",
+               "model", "overall_score", "overall_max", "grade", "feedback", "error", "result_json", "raw_response",
+               "elapsed_seconds", "input_tokens", "output_tokens", "cache_read_input_tokens", "graded_at"]
+    # Re-saving a result from the result cache keeps the response and timing recorded when it was actually graded
+    kept_on_cache_hit = ["model", "raw_response", "elapsed_seconds", "input_tokens", "output_tokens", "cache_read_input_tokens", "graded_at"]
+    
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.lock = threading.Lock()
+        # Autocommit mode; each write below opens its own transaction. API threads share the connection under the lock
+        # Workers wait out each other's writes like the job queue does
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        # WAL needs shared memory, which network filesystems don't provide; workers keep the rollback journal
+        self.connection.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                submission_identifier TEXT PRIMARY KEY,
+                student_id TEXT,
+                name TEXT,
+                date_submitted TEXT,
+                original_filename TEXT,
+                cache_key TEXT,
+                model TEXT,
+                overall_score REAL,
+                overall_max REAL,
+                grade TEXT,
+                feedback TEXT,
+                error INTEGER NOT NULL DEFAULT 0,
+                result_json TEXT NOT NULL,
+                raw_response TEXT,
+                elapsed_seconds REAL,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                cache_read_input_tokens INTEGER,
+                graded_at TEXT
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_student_id ON results (student_id)")
+    
+    def save(self, student_identifier, grading_result, student_info, cache_key=None, raw_response=None,
+             elapsed_seconds=None, usage=None, model=None):
+        """Insert or replace one submission's result"""
+        usage = usage or {}
+        row = {
+            "submission_identifier": student_identifier,
+            "student_id": student_info["student_id"],
+            "name": student_info["name"],
+            "date_submitted": student_info["date_submitted"],
+            "original_filename": student_info["original_filename"],
+            "cache_key": cache_key,
+            "model": model or grading_model,
+            "overall_score": grading_result.get("overall_score"),
+            "overall_max": grading_result.get("overall_max"),
+            "grade": blackboard_grade(grading_result),
+            "feedback": blackboard_feedback(grading_result),
+            "error": int(bool(grading_result.get("error", False))),
+            "result_json": json.dumps(grading_result),
+            "raw_response": raw_response,
+            "elapsed_seconds": elapsed_seconds,
+            "input_tokens": usage.get("input_tokens"),
+            "output_tokens": usage.get("output_tokens"),
+            "cache_read_input_tokens": usage.get("cache_read_input_tokens"),
+            "graded_at": datetime.now(timezone.utc).isoformat() if raw_response is not None else None
+        }
+        updates = []
+        for column in self.columns[1:]:
+            if column in self.kept_on_cache_hit:
+                updates.append(f"{column} = CASE WHEN excluded.raw_response IS NULL AND results.cache_key IS excluded.cache_key "
+                               f"THEN results.{column} ELSE excluded.{column} END")
+            else:
+                updates.append(f"{column} = excluded.{column}")
+        statement = (f"INSERT INTO results ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))}) "
+                     f"ON CONFLICT (submission_identifier) DO UPDATE SET {', '.join(updates)}")
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(statement, [row[column] for column in self.columns])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+    
+    def export_csv(self, csv_path, submission_identifiers=None, student_ids=None):
+        """Stream results into a Blackboard CSV; returns the number of rows written"""
+        select = "SELECT r.name, r.student_id, r.date_submitted, r.original_filename, r.grade, r.feedback, r.error, r.submission_identifier"
+        with self.lock:
+            cursor = self.connection.cursor()
+            if submission_identifiers is not None:
+                # Keep the caller's order (gradebook order) by joining against a temporary ordering table
+                cursor.execute("CREATE TEMP TABLE IF NOT EXISTS export_order (position INTEGER PRIMARY KEY, submission_identifier TEXT)")
+                cursor.execute("DELETE FROM export_order")
+                cursor.executemany("INSERT INTO export_order (submission_identifier) VALUES (?)",
+                                   ((identifier,) for identifier in submission_identifiers))
+                query = f"{select} FROM export_order o JOIN results r USING (submission_identifier) ORDER BY o.position"
+                parameters = []
+            elif student_ids is not None:
+                query = f"{select} FROM results r WHERE r.student_id IN ({', '.join('?' * len(student_ids))}) ORDER BY r.student_id, r.date_submitted"
+                parameters = list(student_ids)
+            else:
+                query = f"{select} FROM results r ORDER BY r.student_id, r.date_submitted"
+                parameters = []
+            
+            row_count = 0
+            # Write to a temporary file first so Blackboard never picks up a half-written CSV
+            tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', newline='') as f:
+                # Same dialect pandas' to_csv used: minimal quoting and the platform's line endings
+                writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL, lineterminator=os.linesep)
+                writer.writerow(["Student Name", "Student ID", "Submission Date", "Submitted File", "Grade", "Feedback"])
+                for name, student_id, date_submitted, original_filename, grade, feedback, error, identifier in cursor.execute(query, parameters):
+                    if error:
+                        print(f"Skipping submission {identifier} in CSV due to processing errors")
+                        continue
+                    writer.writerow([name, student_id, date_submitted, original_filename, grade, feedback])
+                    row_count += 1
+            if row_count:
+                os.replace(tmp_path, csv_path)
+            else:
+                os.remove(tmp_path)
+            return row_count
+    
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+results_store = None
+_results_store_lock = threading.Lock()
+
+def get_results_store():
+    """The results database for the current output_dir, opened on first use"""
+    global results_store
+    with _results_store_lock:
+        if results_store is None or results_store.path != results_db_path or results_store.shared != results_db_shared:
+            os.makedirs(os.path.dirname(results_db_path) or ".", exist_ok=True)
+            results_store = ResultsStore(results_db_path, results_db_shared)
+        return results_store
+
+def save_grading_result(student_identifier, grading_result, cache_key=None, raw_response=None, elapsed_seconds=None, model=None):
+    """Write a student's grading result to <identifier>_grading.json in output_dir and record it (and the response it came from) in the results database"""
+    # Use the submission filename as identifier, but ensure it doesn't have problematic characters
+    safe_identifier = os.path.basename(student_identifier)
+    result_path = os.path.join(output_dir, f"{safe_identifier}_grading.json")
+    with open(result_path, 'w') as f:
+        json.dump(grading_result, f, indent=2)
+    get_results_store().save(student_identifier, grading_result, get_student_info(student_identifier), cache_key=cache_key,
+                             raw_response=raw_response, elapsed_seconds=elapsed_seconds,
+                             usage=run_metrics.student_totals(student_identifier), model=model)
+
+def get_student_info(submission_filename, gradebook_index=None):
+    """Look up student name, ID and submission date for a submission file"""
+    global _gradebook_index
+    if gradebook_index is None:
+        # Build the index once per process when callers don't pass their own
+        if _gradebook_index is None:
+            _gradebook_index = build_gradebook_index()
+        gradebook_index = _gradebook_index
+    
+    record = gradebook_index.get(receipt_key(submission_filename))
+    if record is None:
+        # Student IDs containing underscores break the prefix split; match on the listed filenames instead
+        record = next((r for r in gradebook_index.values() if submission_filename in r["filenames"]), None)
+    
+    if record is None:
+        print(f"No text file found for submission {submission_filename}")
+        return {"name": "Unknown", "student_id": "Unknown", "date_submitted": "Unknown", "original_filename": "Unknown"}
+    
+    return {"name": record["name"], "student_id": record["student_id"], "date_submitted": record["date_submitted"], "original_filename": record["original_filename"]}
+
+def create_blackboard_csv(submission_identifiers=None, student_ids=None):
+    """Create a CSV file for Blackboard import from the results database"""
+    csv_path = os.path.join(output_dir, "blackboard_grades.csv")
+    row_count = get_results_store().export_csv(csv_path, submission_identifiers, student_ids)
+    if not row_count:
+        print("No valid grading results to include in CSV")
+        return None
+    print(f"Created CSV file for Blackboard import at {csv_path} ({row_count} students)")
+    return csv_path
+
+def submit_grading_batch(batch_entries):
+    """Submit one Message Batch and record its manifest so results can be collected even after a crash"""
+    requests = [{"custom_id": custom_id, "params": grading_request_params(message_content, tool=grading_tool)}
+                for custom_id, (_, _, message_content) in batch_entries.items()]
+    batch = anthropic_client.messages.batches.create(requests=requests, extra_headers=beta_headers())
+    print(f"Submitted batch {batch.id} with {len(requests)} submissions")
+    
+    os.makedirs(batch_dir, exist_ok=True)
+    manifest = {custom_id: {"identifier": identifier, "cache_key": cache_key}
+                for custom_id, (identifier, cache_key, _) in batch_entries.items()}
+    with open(os.path.join(batch_dir, f"{batch.id}.json"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return batch.id
 
-def prepare_reference_images():
-    """Prepare reference images that combine both question and solution PDFs"""
-    print("Preparing reference images (question and solution)...")
+def collect_grading_batch(batch_id):
+    """Wait for a submitted batch to end, then save each result and return them keyed by submission identifier"""
+    manifest_path = os.path.join(batch_dir, f"{batch_id}.json")
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
     
-    # Convert question PDF to images
-    question_images = pdf_to_images(question_path, dpi=100)
-    question_images = [compress_image(img) for img in question_images]
-    print(f"Processed question PDF with {len(question_images)} pages")
+    while True:
+        batch = anthropic_client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            break
+        counts = batch.request_counts
+        print(f"Batch {batch_id} still {batch.processing_status} ({counts.processing} processing, {counts.succeeded} succeeded). Checking again in {batch_poll_interval} seconds...")
+        time.sleep(batch_poll_interval)
     
-    # Convert solution PDF to images
-    solution_images = pdf_to_images(solution_path, dpi=100)
-    solution_images = [compress_image(img) for img in solution_images]
-    print(f"Processed solution PDF with {len(solution_images)} pages")
+    results = {}
+    for entry in anthropic_client.messages.batches.results(batch_id):
+        if entry.custom_id not in manifest:
+            continue
+        identifier = manifest[entry.custom_id]["identifier"]
+        raw_response = None
+        try:
+            if entry.result.type != "succeeded":
+                error = getattr(entry.result, "error", None)
+                raise ValueError(f"batch request {entry.result.type}" + (f": {error}" if error else ""))
+            run_metrics.record_usage(identifier, entry.result.message.usage)
+            grading_result, raw_response = grading_from_message(entry.result.message)
+            # No follow-up turns here (the request content isn't kept); an incomplete grading is regraded next run
+            valid, missing = check_grading(grading_result)
+            if missing:
+                raise ValueError(f"no valid grade for problem(s) {missing}")
+            grading_result = dict(grading_result, problems=[valid[number] for number in sorted(valid)],
+                                  overall_score=sum(problem["score"] for problem in valid.values()))
+            print(f"Successfully processed submission for student {identifier}")
+        except Exception as e:
+            print(f"API error for student {identifier}: {str(e)}")
+            grading_result = {
+                "problems": [],
+                "overall_score": 0,
+                "overall_max": problem_count * problem_max_score,
+                "overall_feedback": f"API error: {str(e)}",
+                "error": True
+            }
+        save_cached_result(manifest[entry.custom_id]["cache_key"], grading_result)
+        save_grading_result(identifier, grading_result, manifest[entry.custom_id]["cache_key"], raw_response)
+        results[identifier] = grading_result
     
-    return {
-        'question_images': question_images,
-        'solution_images': solution_images
-    }
+    # Anything the batch didn't return is left ungraded and will be retried on the next run
+    for custom_id, entry in manifest.items():
+        if entry["identifier"] not in results:
+            print(f"No batch result for student {entry['identifier']}")
+    
+    os.remove(manifest_path)
+    return results
 
-def process_submission(submission_path, student_identifier, reference_images=None):
-    """Process a single student submission"""
-    print(f"Processing submission for student {student_identifier}...")
+def collect_pending_batches():
+    """Collect batches submitted by an earlier run that never picked up their results"""
+    if not os.path.isdir(batch_dir):
+        return
+    for manifest_file in sorted(os.listdir(batch_dir)):
+        if manifest_file.endswith('.json'):
+            batch_id = manifest_file[:-len('.json')]
+            print(f"Collecting results of batch {batch_id} from a previous run")
+            try:
+                collect_grading_batch(batch_id)
+            except Exception as e:
+                print(f"Error collecting batch {batch_id}: {str(e)}")
+
+class GradingBatches:
+    """Message Batches filled as students' requests are built; each batch is submitted as soon as it is full"""
+    
+    def __init__(self):
+        self.batch_ids = []
+        self.entries = {}  # custom_id -> (identifier, cache_key, message_content) of the batch being filled
+        self.entries_bytes = 0
+        self.request_count = 0
+    
+    def add(self, identifier, cache_key, message_content):
+        """Queue one student's request, first submitting the current batch if this one wouldn't fit in it"""
+        request_bytes = payload_bytes(message_content)
+        run_metrics.record_student(identifier, payload_bytes=request_bytes)
+        if self.entries and (len(self.entries) >= batch_max_requests or self.entries_bytes + request_bytes > batch_max_bytes):
+            self.submit()
+        # Batch custom_ids only allow [a-zA-Z0-9_-], so submissions are mapped back through the manifest
+        self.entries[f"submission-{self.request_count:05d}"] = (identifier, cache_key, message_content)
+        self.entries_bytes += request_bytes
+        self.request_count += 1
     
+    def submit(self):
+        """Submit the batch being filled, letting go of its request bodies"""
+        if self.entries:
+            self.batch_ids.append(submit_grading_batch(self.entries))
+            self.entries, self.entries_bytes = {}, 0
+    
+    def collect(self):
+        """Submit what's left, then wait for every batch and return the results keyed by submission identifier"""
+        self.submit()
+        results = {}
+        for batch_id in self.batch_ids:
+            results.update(collect_grading_batch(batch_id))
+        return results
+
+def batch_prepared_submission(batches, prepare_future, submission_identifier, reference_images, cache_key):
+    """Batch stage: take a student's prepared pages off the prefetch queue and add their request to the current batch"""
     try:
-        # If reference images weren't provided, create them now
-        if reference_images is None:
-            reference_images = prepare_reference_images()
-            
-        question_images = reference_images['question_images']
-        solution_images = reference_images['solution_images']
-        
-        # Convert student submission to images
-        if submission_path.lower().endswith('.pdf'):
-            student_images = pdf_to_images(submission_path, dpi=100)
-            student_images = [compress_image(img) for img in student_images]
-            print(f"Processed student submission with {len(student_images)} pages")
-        else:
-            # If it's already an image file, just load it
+        student_images, student_documents = collect_prepared_pages(prepare_future, submission_identifier)
+    except Exception as e:
+        print(f"Error processing submission {submission_identifier}: {str(e)}")
+        return
+    if not student_images and not student_documents:
+        return
+    if report_near_identical_pages:
+        submission_groups.match_pages(submission_identifier, student_images, student_documents)
+    batches.add(submission_identifier, cache_key, build_message_content(student_images, reference_images, student_documents))
+
+class JobQueue:
+    """Durable queue of gradebook submissions in SQLite, shared by worker processes through time-limited leases"""
+    
+    def __init__(self, path, worker_id, lease_seconds=None):
+        self.path = path
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds or job_lease_seconds
+        self.lock = threading.Lock()
+        self.held = set()  # Receipt keys this worker has leased and not yet finished
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = None
+        # Other workers hold the database lock briefly while claiming; wait for them rather than failing
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                receipt_key TEXT PRIMARY KEY,
+                submission_identifier TEXT NOT NULL,
+                cache_key TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)")
+    
+    def _transaction(self, statements):
+        """Run (sql, parameters) statements in one write transaction; returns the last cursor"""
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
             try:
-                img = Image.open(submission_path)
-                student_images = [compress_image(img)]
-            except Exception as e:
-                print(f"Error loading image file: {str(e)}")
-                return {
-                    "problems": [],
-                    "overall_score": 0,
-                    "overall_max": 100,
-                    "overall_feedback": f"Error loading image file: {str(e)}",
-                    "error": True
-                }
-        
-        # Create the grading prompt
-        grading_prompt = """
-        You are an expert teaching assistant grading a Digital Signal Processing (ECE317) homework assignment.
-        
-        I have provided multiple images in the following order:
-        1. First set: The homework questions
-        2. Second set: The solution to the assignment
-        3. Third set: The student's submission
-        
-        This homework has 5 questions, each worth 20 marks (for a total of 100 marks).
-        
-        Please grade this submission carefully, following these specific guidelines:
-        - Award full marks (20) if the answer is perfect and matches the solution
-        - Award partial marks (15-18) if the answer is partially correct or has minor errors
-        - Award 0 marks if the question is not attempted
-        - Be generous with partial credit (prefer to give 18-15 rather than lower scores)
-        
-        For ONLY the questions that did NOT receive full marks (20), provide a single line of 
-        feedback explaining why marks were deducted. The feedback should be very brief and to the point.
-        
-        Format your response as JSON with the following structure:
-        {
-            "problems": [
-                {
-                    "problem_number": 1,
-                    "score": 20,  // Full marks example, no feedback needed
-                    "max_score": 20
-                },
-                {
-                    "problem_number": 2,
-                    "score": 18,  // Partial marks example
-                    "max_score": 20,
-                    "feedback": "Missed the aliasing explanation in the frequency domain."
-                },
-                // Repeat for all 5 questions
-            ],
-            "overall_score": Z,  // Sum of all 5 question scores
-            "overall_max": 100,
-            "overall_feedback": "Brief summary of the student's overall performance"
-        }
-        
-        Return only the JSON with no additional text. Ensure you grade all 5 questions.
-        """
-        
-        # Prepare message content with images
-        message_content = [{"type": "text", "text": grading_prompt}]
-        
-        # Add question images
-        for i, img in enumerate(question_images):
-            message_content.append({
-                "type": "text",
-                "text": f"QUESTION PAGE {i+1}:"
-            })
-            message_content.append({
-                "type": "image", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "image/jpeg", 
-                    "data": image_to_base64(img)
-                }
-            })
-            
-        # Add solution images
-        for i, img in enumerate(solution_images):
-            message_content.append({
-                "type": "text",
-                "text": f"SOLUTION PAGE {i+1}:"
-            })
-            message_content.append({
-                "type": "image", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "image/jpeg", 
-                    "data": image_to_base64(img)
-                }
-            })
-        
-        # Add student images
-        message_content.append({
-            "type": "text",
-            "text": "STUDENT SUBMISSION:"
-        })
-        
-        for i, img in enumerate(student_images):
-            message_content.append({
-                "type": "text",
-                "text": f"STUDENT PAGE {i+1}:"
-            })
-            message_content.append({
-                "type": "image", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "image/jpeg", 
-                    "data": image_to_base64(img)
-                }
-            })
-        
-        # Add retry logic with exponential backoff
-        max_retries = 5
-        base_delay = 10  # seconds
-        
-        for attempt in range(max_retries):
+                cursor = None
+                for sql, parameters in statements:
+                    cursor = self.connection.execute(sql, parameters)
+                self.connection.execute("COMMIT")
+                return cursor
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+    
+    def enqueue(self, jobs):
+        """Add (receipt_key, submission_identifier, cache_key) jobs; a job whose files or settings changed is graded again"""
+        now = time.time()
+        self._transaction([(
+            "INSERT INTO jobs (receipt_key, submission_identifier, cache_key, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (receipt_key) DO UPDATE SET submission_identifier = excluded.submission_identifier, "
+            "cache_key = excluded.cache_key, state = 'pending', worker = NULL, lease_expires = NULL, attempts = 0, "
+            "last_error = NULL, updated_at = excluded.updated_at WHERE jobs.cache_key != excluded.cache_key",
+            (receipt_key, identifier, cache_key, now)) for receipt_key, identifier, cache_key in jobs])
+    
+    def claim(self):
+        """Lease the next pending job (or one whose lease expired), returning its receipt key or None"""
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
             try:
-                print(f"API attempt {attempt+1}/{max_retries}...")
-                # Call Claude API
-                response = anthropic_client.messages.create(
-                    model="claude-3-7-sonnet-20250219",
-                    max_tokens=4000,
-                    temperature=0,
-                    system="You are a Digital Signal Processing teaching assistant. Grade homework submissions accurately and fairly, focusing only on the technical content. Format your response as JSON.",
-                    messages=[
-                        {"role": "user", "content": message_content}
-                    ]
-                )
-                
-                # Extract JSON from Claude's response
-                response_text = response.content[0].text
-                # Find JSON in the response (in case Claude adds any text before/after)
-                json_start = response_text.find('{')
-                json_end = response_text.rfind('}') + 1
-                if json_start >= 0 and json_end > json_start:
-                    json_str = response_text[json_start:json_end]
-                    grading_result = json.loads(json_str)
-                    print(f"Successfully processed submission for student {student_identifier}")
-                    # Success! Break out of retry loop
-                    break
-                else:
-                    raise ValueError("No JSON found in the response")
-                    
-            except Exception as e:
-                if "rate_limit_error" in str(e) and attempt < max_retries - 1:
-                    # Rate limit hit, apply exponential backoff
-                    delay = base_delay * (2 ** attempt) + random.uniform(1, 5)
-                    print(f"Rate limit hit. Retrying in {delay:.2f} seconds...")
-                    time.sleep(delay)
-                else:
-                    # Other error or final retry failed
-                    print(f"API error for student {student_identifier}: {str(e)}")
-                    grading_result = {
-                        "problems": [],
-                        "overall_score": 0,
-                        "overall_max": 100,
-                        "overall_feedback": f"API error: {str(e)}",
-                        "error": True
-                    }
-                    break
-                
-    except Exception as e:
-        print(f"Processing error for student {student_identifier}: {str(e)}")
-        grading_result = {
-            "problems": [],
-            "overall_score": 0,
-            "overall_max": 100,
-            "overall_feedback": f"Processing error: {str(e)}",
-            "error": True
-        }
+                # A job whose worker keeps dying on it (out of memory, a hung poppler) would otherwise come back forever
+                self.connection.execute(
+                    "UPDATE jobs SET state = 'failed', worker = NULL, lease_expires = NULL, "
+                    "last_error = 'lease expired on its last attempt', updated_at = ? "
+                    "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, max_job_attempts))
+                row = self.connection.execute(
+                    "SELECT receipt_key FROM jobs WHERE state = 'pending' "
+                    "OR (state = 'leased' AND lease_expires < ? AND attempts < ?) "
+                    "ORDER BY receipt_key LIMIT 1", (now, max_job_attempts)).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+                        "WHERE receipt_key = ?", (self.worker_id, now + self.lease_seconds, now, row[0]))
+                    self.held.add(row[0])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return row[0] if row is not None else None
     
-    # Save the grading result with a consistent filename
-    # Use the submission filename as identifier, but ensure it doesn't have problematic characters
-    safe_identifier = os.path.basename(student_identifier)
-    result_path = os.path.join(output_dir, f"{safe_identifier}_grading.json")
-    with open(result_path, 'w') as f:
-        json.dump(grading_result, f, indent=2)
+    def _finish(self, receipt_key, state, error=None):
+        # Only the current lease holder may finish a job; if our lease expired and another worker took it, leave it alone
+        self._transaction([(
+            "UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, last_error = ?, updated_at = ? "
+            "WHERE receipt_key = ? AND state = 'leased' AND worker = ?",
+            (state, error, time.time(), receipt_key, self.worker_id))])
+        with self.lock:
+            self.held.discard(receipt_key)
     
-    return grading_result
-
-def get_student_info(submission_filename):
-    """Extract student name and submission date from the text file"""
-    # The submission filename should be in this format:
-    # "Homework 3_studentid_attempt_timestamp_originalname.pdf"
+    def complete(self, receipt_key):
+        """Mark a leased job graded"""
+        self._finish(receipt_key, "done")
     
-    # Split by underscore to get parts
-    parts = submission_filename.split('_')
-    if len(parts) < 4:
-        return {"name": "Unknown", "date_submitted": "Unknown", "original_filename": "Unknown"}
+    def release(self, receipt_key, error):
+        """Give a failed job back to the queue, or give up on it after max_job_attempts"""
+        with self.lock:
+            row = self.connection.execute("SELECT attempts FROM jobs WHERE receipt_key = ?", (receipt_key,)).fetchone()
+        attempts = row[0] if row is not None else max_job_attempts
+        self._finish(receipt_key, "failed" if attempts >= max_job_attempts else "pending", error)
     
-    # Construct the base pattern for finding the corresponding text file
-    base_pattern = f"{parts[0]}_{parts[1]}_{parts[2]}_{parts[3]}"
+    def fail(self, receipt_key, error):
+        """Mark a leased job as not gradeable (e.g. no readable pages), so no worker retries it"""
+        self._finish(receipt_key, "failed", error)
     
-    # Search for the matching text file
-    txt_files = []
-    for root, dirs, files in os.walk(student_dir):
-        for file in files:
-            if file.startswith(base_pattern) and file.endswith('.txt'):
-                txt_files.append(os.path.join(root, file))
+    def outstanding(self):
+        """Number of jobs still pending or leased by any worker"""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'leased')").fetchone()[0]
     
-    if not txt_files:
-        print(f"No text file found for submission {submission_filename}")
-        return {"name": "Unknown", "date_submitted": "Unknown", "original_filename": "Unknown"}
+    def counts(self):
+        """Number of jobs in each state"""
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+    
+    def _heartbeat(self):
+        while not self.stop_heartbeat.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held)
+            if not held:
+                continue
+            try:
+                # Extend our leases while the jobs are still being prepared or graded
+                self._transaction([(
+                    "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE receipt_key = ? AND state = 'leased' AND worker = ?",
+                    (time.time() + self.lease_seconds, time.time(), receipt_key, self.worker_id)) for receipt_key in held])
+            except sqlite3.Error as e:
+                print(f"Job queue heartbeat failed: {str(e)}")
     
-    # Use the first matching text file
-    txt_file = txt_files[0]
+    def start_heartbeat(self):
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, name="job-queue-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
     
-    # Read the text file
+    def close(self):
+        self.stop_heartbeat.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+        with self.lock:
+            self.connection.close()
+
+def claimed_records(job_queue, gradebook_index, payload_slots):
+    """Yield gradebook records as this worker leases them, until no job is pending or leased anywhere"""
+    while True:
+        # Lease a job only once this worker has a free payload slot for it, so idle workers get the rest of the queue.
+        # The caller is the only one taking slots, so the slot is still free when it asks for it
+        payload_slots.acquire()
+        payload_slots.release()
+        receipt_key = job_queue.claim()
+        if receipt_key is not None:
+            if receipt_key in gradebook_index:
+                yield gradebook_index[receipt_key]
+            else:
+                # Queued by a worker that sees a different gradebook
+                job_queue.fail(receipt_key, "receipt not found in this worker's gradebook")
+            continue
+        if not job_queue.outstanding():
+            return
+        # Other workers (or our own API threads) still hold leases; a failed job may come back to the queue
+        time.sleep(job_poll_interval)
+
+def finish_job(job_queue, receipt_key, result_future):
+    """Done-callback for a graded student: complete the job, or give it back to the queue if grading failed"""
     try:
-        with open(txt_file, 'r') as f:
-            lines = f.readlines()
-        
-        # Extract student name and submission date
-        student_name = "Unknown"
-        student_id = "Unknown"
-        date_submitted = "Unknown"
-        original_filename = "Unknown"
-        
-        in_files_section = False
-        
-        for line in lines:
-            line = line.strip()
-            if line.startswith("Name:"):
-                # Format: "Name: John Doe (jdoe)"
-                name_parts = line.split("(")
-                if len(name_parts) > 1:
-                    student_name = name_parts[0].replace("Name:", "").strip()
-                    student_id_part = name_parts[1].replace(")", "").strip()
-                    student_id = student_id_part
-            elif line.startswith("Date Submitted:"):
-                date_submitted = line.replace("Date Submitted:", "").strip()
-            elif line == "Files:":
-                in_files_section = True
-            elif in_files_section and line.startswith("Original filename:"):
-                original_filename = line.replace("Original filename:", "").strip()
-                in_files_section = False  # Stop after getting the first filename
+        result = result_future.result()
+    except Exception as e:
+        job_queue.release(receipt_key, str(e))
+        return
+    if result is None:
+        job_queue.fail(receipt_key, "no valid pages")
+    elif result.get("error", False):
+        job_queue.release(receipt_key, result.get("overall_feedback", "grading error"))
+    else:
+        job_queue.complete(receipt_key)
+
+# Module settings copied into prefetch worker processes (which may not inherit runtime changes to globals)
+_prefetch_setting_names = ["page_cache_dir", "drop_blank_pages", "drop_duplicate_pages", "blank_ink_coverage",
+                           "ink_contrast", "duplicate_hash_distance", "duplicate_pixel_difference", "min_page_side",
+                           "min_jpeg_quality", "clean_scans", "binarize_scans", "crop_padding", "send_native_pdfs",
+                           "native_pdf_max_pages", "native_pdf_max_bytes", "pdf_page_tokens"]
+
+def _init_prefetch_worker(settings):
+    """Initialize a prefetch worker process with the parent's settings"""
+    global run_metrics
+    globals().update(settings)
+    run_metrics = RunMetrics()
+    # Ctrl-C is handled by the parent (e.g. to stop --watch), which then shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def known_file_digests(paths):
+    """The already-computed hashes of these files, so worker processes don't read them a second time"""
+    memo_keys = [_digest_memo_key(path) for path in paths]
+    return {memo_key: _file_digests[memo_key] for memo_key in memo_keys if memo_key in _file_digests}
+
+def prepare_student_pages(submission_paths, file_digests=None, page_budget=None):
+    """Rasterize and encode all of a student's files into JPEG pages (runs in a prefetch worker process)"""
+    _file_digests.update(file_digests or {})
+    all_student_images = []
+    student_documents = []
+    token_budget, byte_budget = page_budget or (request_token_budget, request_byte_budget)
+    for idx, full_submission_path in enumerate(submission_paths):
+        submission_filename = os.path.basename(full_submission_path)
+        print(f"Processing file {idx+1}/{len(submission_paths)}: {submission_filename}")
         
-        return {"name": student_name, "student_id": student_id, "date_submitted": date_submitted, "original_filename": original_filename}
+        # Convert student submission to JPEG pages (from the page cache when possible) and add to collection
+        file_ext = full_submission_path.lower().split('.')[-1] if '.' in full_submission_path else ''
+        document = load_native_pdf(full_submission_path) if send_native_pdfs and file_ext == 'pdf' else None
+        if document and document["pages"] * pdf_page_tokens <= token_budget and len(document["data"]) <= byte_budget:
+            # Typed or small PDFs go to the API as they are, so there's nothing to rasterize
+            student_documents.append(document)
+            token_budget -= document["pages"] * pdf_page_tokens
+            byte_budget -= len(document["data"])
+            run_metrics.count("native_pdfs")
+            print(f"Added PDF file {submission_filename} natively ({document['pages']} pages)")
+        elif file_ext == 'pdf':
+            student_file_images = load_pages(full_submission_path, dpi=100)
+            all_student_images.extend(student_file_images)
+            print(f"Added {len(student_file_images)} pages from PDF file {submission_filename}")
+        elif file_ext in ['jpg', 'jpeg', 'png']:
+            try:
+                all_student_images.extend(load_pages(full_submission_path))
+                print(f"Added image file {submission_filename}")
+            except Exception as e:
+                print(f"Error loading image file {submission_filename}: {str(e)}")
     
-    except Exception as e:
-        print(f"Error reading text file for submission {submission_filename}: {str(e)}")
-        return {"name": "Unknown", "student_id": "Unknown", "date_submitted": "Unknown", "original_filename": "Unknown"}
+    # Drop blank backsides and pages uploaded twice, across all of the student's files
+    all_student_images = filter_pages(all_student_images)
+    
+    # Shrink big submissions so the request fits its token and byte budget
+    if page_budget:
+        all_student_images = fit_pages_to_budget(all_student_images, token_budget, byte_budget)
+    
+    # Stage timings recorded in this process are shipped back with the pages
+    return all_student_images, student_documents, run_metrics.drain()
 
-def create_blackboard_csv(grading_results):
-    """Create a CSV file for Blackboard import"""
-    # Create dataframe for Blackboard import
-    data = []
-    for submission_filename, result in grading_results.items():
-        # Skip errored results or add placeholder for them
-        if result.get("error", False):
-            print(f"Skipping submission {submission_filename} in CSV due to processing errors")
-            continue
-            
-        # Calculate percentage
-        if result.get("overall_max", 0) > 0:
-            percentage = (result.get("overall_score", 0) / result.get("overall_max", 100)) * 100
-        else:
-            percentage = 0
-            
-        # Format feedback as comma-separated list for questions without full marks
-        feedback_parts = []
+def collect_prepared_pages(prepare_future, submission_identifier):
+    """Wait for a student's pages and native PDFs from the prefetch stage, merging the worker's stage timings"""
+    student_images, student_documents, worker_metrics = prepare_future.result()
+    run_metrics.merge(worker_metrics)
+    if not student_images and not student_documents:
+        print(f"No valid images found in submission files for student {submission_identifier}")
+    return student_images, student_documents
+
+def grade_prepared_submission(prepare_future, submission_identifier, reference_images, cache_key, payload_slots=None):
+    """API stage: take a student's prepared pages off the prefetch queue and grade them (releasing its payload slot, if any)"""
+    result = None
+    try:
+        student_images, student_documents = collect_prepared_pages(prepare_future, submission_identifier)
+        if not student_images and not student_documents:
+            return None
         
-        # Only include feedback for problems that didn't get full marks
-        for problem in result.get("problems", []):
-            if problem.get("score", 20) < 20 and "feedback" in problem:
-                feedback_parts.append(f"Q{problem['problem_number']}: {problem.get('feedback', '')}")
+        # Pages that only look alike may still hold different answers, so a match is reported for review but not shared
+        if report_near_identical_pages:
+            submission_groups.match_pages(submission_identifier, student_images, student_documents)
         
-        # Join with commas
-        feedback = ", ".join(feedback_parts)
+        print(f"Processing all {len(student_images)} pages and {len(student_documents)} native PDFs for {submission_identifier}")
+        if per_problem_grading:
+            result = process_submission_per_problem(student_images, submission_identifier, reference_images, cache_key)
+        else:
+            result = process_submission_with_images(student_images, submission_identifier, reference_images, cache_key, student_documents)
+        return result
+    finally:
+        # Let submissions waiting on this one go ahead, and free the slot so the producer can prepare another student
+        submission_groups.finish(submission_identifier, result)
+        if payload_slots is not None:
+            payload_slots.release()
+
+def gradebook_identifiers(gradebook_index):
+    """Submission identifiers (first uploaded filename) of every gradebook record, in gradebook order"""
+    return [os.path.basename(record["submission_paths"][0]) for record in gradebook_index.values() if record["submission_paths"]]
+
+def receipt_signature(record):
+    """Sizes and modification times of a receipt and its uploads, or None while any of them is missing"""
+    try:
+        return tuple((os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                     for path in [record["txt_path"]] + record["submission_paths"])
+    except OSError:
+        return None
+
+class SubmissionGroups:
+    """Groups of byte-identical submissions, which share the first one's result, and near-identical ones, which are only reported"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leaders = {}  # grading cache key -> identifier of the submission graded for it
+        # (page count, native PDF digests) -> [(identifier, hash bits, aspect ratios, packed ink masks)] of submissions that matched no earlier one
+        self.page_leaders = {}
+        self.members = {}  # leader identifier -> [(identifier, "identical" or "near_identical")]
+        self.grouped = set()  # identifiers that are members of some group
+        self.done = {}  # leader identifier -> Event set once its result is in
+        self.results = {}  # leader identifier -> result, or None if grading it failed
+    
+    def claim(self, identifier, cache_key):
+        """Return the submission already being graded from exactly these files, or None after making this one a leader"""
+        with self.lock:
+            leader = self.leaders.get(cache_key)
+            if leader is None or leader == identifier:
+                self.leaders[cache_key] = identifier
+                self.done.setdefault(identifier, threading.Event())
+                return None
+            self.members.setdefault(leader, []).append((identifier, "identical"))
+            self.grouped.add(identifier)
+        run_metrics.count("duplicate_submissions")
+        return leader
+    
+    def match_pages(self, identifier, student_images, student_documents):
+        """Record this submission under an earlier one whose pages all match it and return that one, or None"""
+        documents = tuple(sorted(hashlib.sha256(document["data"].encode('ascii')).hexdigest() for document in student_documents))
+        bits, aspects, ink = np.zeros((0, 63), dtype=bool), np.zeros(0), np.zeros((0, 0), dtype=np.uint8)
+        if student_images:
+            thumbnails, bits, aspects = page_signatures(student_images)
+            # Only the ink masks are kept for the rest of the run, at a bit per pixel
+            ink = np.packbits(inner_ink(thumbnails)[1], axis=1)
+        with self.lock:
+            # A byte-identical copy graded on its own is already in its group
+            if identifier in self.grouped:
+                return None
+            # Only submissions with as many pages and the same native PDFs can match
+            candidates = self.page_leaders.setdefault((len(bits), documents), [])
+            leader = None
+            if candidates:
+                # Cheap checks on every candidate at once: each page's perceptual hash and shape against the page in the same position
+                leader_bits = np.stack([candidate[1] for candidate in candidates])
+                leader_aspects = np.stack([candidate[2] for candidate in candidates])
+                close = (((leader_bits != bits).sum(axis=2) <= duplicate_hash_distance)
+                         & (np.abs(leader_aspects - aspects) < 0.1)).all(axis=1)
+                # Then compare the writing itself, only on the few candidates left
+                for index in np.flatnonzero(close):
+                    if candidates[index][0] != identifier and ink_overlaps(ink, candidates[index][3]):
+                        leader = candidates[index][0]
+                        break
+            if leader is None:
+                candidates.append((identifier, bits, aspects, ink))
+                return None
+            self.members.setdefault(leader, []).append((identifier, "near_identical"))
+            self.grouped.add(identifier)
+        run_metrics.count("near_identical_submissions")
+        return leader
+    
+    def grade_alone(self, leader, identifier):
+        """Mark a byte-identical member as graded on its own, after its leader could not be graded"""
+        with self.lock:
+            self.members[leader] = [(member, "identical_graded_alone" if member == identifier else match)
+                                    for member, match in self.members[leader]]
+    
+    def finish(self, identifier, result):
+        """Record a leader's result (None if it couldn't be graded) and wake the submissions waiting on it"""
+        with self.lock:
+            self.results[identifier] = None if result is None or result.get("error", False) else result
+            event = self.done.setdefault(identifier, threading.Event())
+        event.set()
+    
+    def result_for(self, leader):
+        """Wait for a leader's result; None means the member has to be graded on its own"""
+        self.done[leader].wait()
+        with self.lock:
+            return self.results.get(leader)
+    
+    def report(self):
+        """The groups with more than one submission, with the student behind each one"""
+        with self.lock:
+            members = {leader: list(group) for leader, group in self.members.items()}
+        groups = []
+        for leader, group in members.items():
+            submissions = [(leader, "graded")] + group
+            groups.append({
+                "graded_submission": leader,
+                "submissions": [dict(get_student_info(identifier), submission=identifier, match=match,
+                                     shared_grade=match == "identical")
+                                for identifier, match in submissions]
+            })
+        return groups
+    
+    def write_report(self, path=None):
+        """Write the duplicate groups report as JSON"""
+        groups = self.report()
+        with open(path or duplicate_groups_path, 'w') as f:
+            json.dump({"groups": groups}, f, indent=2)
+        return groups
+
+submission_groups = SubmissionGroups()  # Recreated by main() for each run
+
+def share_group_result(identifier, result, cache_key=None):
+    """Record a group leader's result for one of the submissions that matched it"""
+    print(f"Submission {identifier} matches an already graded submission; reusing its result")
+    if cache_key:
+        save_cached_result(cache_key, result)
+    save_grading_result(identifier, result, cache_key)
+    return result
+
+def share_duplicate_result(submission_identifier, leader, cache_key, submission_paths, reference_images, page_budget, prefetch_pool):
+    """Wait for the submission with the same files to be graded, then record its grade for this one too"""
+    shared_result = submission_groups.result_for(leader)
+    if shared_result is not None:
+        return share_group_result(submission_identifier, shared_result, cache_key)
+    
+    # The leader's failure may have been a passing API error, so this copy still gets its own attempt
+    print(f"Submission {leader} with the same files could not be graded, grading {submission_identifier} on its own")
+    submission_groups.grade_alone(leader, submission_identifier)
+    prepare_future = prefetch_pool.submit(prepare_student_pages, submission_paths, known_file_digests(submission_paths), page_budget)
+    return grade_prepared_submission(prepare_future, submission_identifier, reference_images, cache_key)
+
+def watch_gradebook(gradebook_index, reference_images, page_budget, prefetch_pool, executor, payload_slots):
+    """Grade the gradebook, then keep grading new or changed receipts as they land in student_dir"""
+    global _gradebook_index
+    graded_signatures = {}  # receipt key -> signature of the files that were graded
+    seen_signatures = {}  # receipt key -> signature on the previous poll
+    failed = {}  # receipt key -> (signature, failures in a row, time of the next retry) of students whose grading failed
+    reference_digests = (file_sha256(question_path), file_sha256(solution_path))
+    records = list(gradebook_index.values())
+    while True:
+        if records:
+            signatures = {record["key"]: receipt_signature(record) for record in records}
+            results = grade_records(records, gradebook_index, reference_images, page_budget, prefetch_pool, executor, payload_slots)
+            # Only a successful grade counts; API errors (e.g. a burst of 429s near the deadline) are retried with backoff
+            now = time.time()
+            for record in records:
+                key = record["key"]
+                result = results.get(os.path.basename(record["submission_paths"][0])) if record["submission_paths"] else None
+                if result is not None and not result.get("error", False):
+                    graded_signatures[key] = signatures[key]
+                    failed.pop(key, None)
+                    continue
+                failures = failed[key][1] + 1 if key in failed and failed[key][0] == signatures[key] else 1
+                failed[key] = (signatures[key], failures, now + min(watch_retry_max_interval, watch_interval * 2 ** failures))
+            create_blackboard_csv(gradebook_identifiers(gradebook_index))
+            summary = run_metrics.write_reports()
+            submission_groups.write_report()
+            print(f"Graded {summary['students_graded']} submissions via the API since starting. "
+                  f"Watching {student_dir} for new submissions (Ctrl-C to stop)...")
         
-        # Get student name and submission date
-        student_info = get_student_info(submission_filename)
+        time.sleep(watch_interval)
+        gradebook_index = build_gradebook_index()
+        _gradebook_index = gradebook_index
         
-        data.append({
-            "Student Name": student_info["name"],
-            "Student ID": student_info["student_id"],
-            "Submission Date": student_info["date_submitted"],
-            "Submitted File": student_info["original_filename"],
-            "Grade": f"{percentage:.2f}",
-            "Feedback": feedback
-        })
-    
-    if not data:
-        print("No valid grading results to include in CSV")
-        return None
+        # New question or solution PDFs change every grade; rebuild the references and regrade everyone
+        if (file_sha256(question_path), file_sha256(solution_path)) != reference_digests:
+            print("Question or solution PDF changed, preparing reference images again")
+            reference_digests = (file_sha256(question_path), file_sha256(solution_path))
+            problems = reference_images.get('problems')
+            reference_images = prepare_reference_images()
+            page_budget = page_budget_for(reference_images)
+            if problems is not None:
+                reference_images['problems'] = prepare_problem_references(reference_images)
+            graded_signatures = {}
+            failed = {}
         
-    # Create DataFrame and save to CSV
-    df = pd.DataFrame(data)
-    csv_path = os.path.join(output_dir, "blackboard_grades.csv")
-    df.to_csv(csv_path, index=False)
-    print(f"Created CSV file for Blackboard import at {csv_path}")
-    return csv_path
+        records = []
+        for key, record in gradebook_index.items():
+            signature = receipt_signature(record)
+            if signature is None or graded_signatures.get(key) == signature:
+                continue
+            retry = failed.get(key)
+            if retry is not None and retry[0] == signature:
+                # Same files as the failed attempt; they're known to be complete, so only the backoff applies
+                if time.time() >= retry[2]:
+                    records.append(record)
+                continue
+            # Only grade once a receipt and its uploads are unchanged since the last poll, i.e. finished copying
+            if seen_signatures.get(key) == signature:
+                records.append(record)
+            seen_signatures[key] = signature
+        if records:
+            print(f"Found {len(records)} new, changed or failed submissions")
 
-def main():
-    """Main function to process all submissions"""
+def grade_records(records, gradebook_index, reference_images, page_budget, prefetch_pool, executor, payload_slots,
+                  batch=False, job_queue=None):
+    """Grade gradebook records through the prefetch/API pipeline (or in batches); returns results keyed by submission identifier"""
     # Dictionary to store all grading results
     all_results = {}
     
-    # Get a list of student submission text files first
-    txt_files = []
-    for root, dirs, files in os.walk(student_dir):
-        for file in files:
-            if file.endswith('.txt') and file.startswith('Homework 3_'):
-                txt_files.append(os.path.join(root, file))
-    
-    if not txt_files:
-        print("No student submission metadata files found. Check the directory path.")
-        return
-        
-    print(f"Found {len(txt_files)} student submissions")
-    
-    # Prepare reference images once to avoid repetitive processing
-    reference_images = prepare_reference_images()
-    
     # Process submissions
     test_limit = None  # Process all submissions
     processed_count = 0
     
-    for txt_file in txt_files:
+    # --batch mode: students still being prepared, (submission_identifier, cache_key, prepare_future), and all queued
+    batches = GradingBatches()
+    batch_pending = deque()
+    batch_identifiers = []
+    
+    for record in records:
+        submission_identifier = None
         try:
-            # Extract student information from the text file
-            with open(txt_file, 'r') as f:
-                lines = f.readlines()
-            
-            # Extract student ID and submission filename
-            student_name = "Unknown"
-            student_id = os.path.basename(txt_file).split('_attempt_')[0]  # Extract ID from filename
-            submission_filenames = []
-            
-            in_files_section = False
-            full_submission_paths = []
-            
-            for line in lines:
-                line = line.strip()
-                if line.startswith("Name:"):
-                    # Format: "Name: John Doe (jdoe)"
-                    name_parts = line.strip().split("(")
-                    if len(name_parts) > 1:
-                        student_name = name_parts[0].replace("Name:", "").strip()
-                elif line == "Files:":
-                    in_files_section = True
-                elif in_files_section and line.startswith("Filename:"):
-                    submission_filename = line.replace("Filename:", "").strip()
-                    full_submission_path = os.path.join(os.path.dirname(txt_file), submission_filename)
-                    file_ext = submission_filename.lower().split('.')[-1] if '.' in submission_filename else ''
-                    if os.path.exists(full_submission_path) and (file_ext in ['pdf', 'jpg', 'jpeg', 'png']):
-                        submission_filenames.append(submission_filename)
-                        full_submission_paths.append(full_submission_path)
+            # Student information was already parsed from the text file by the index
+            student_name = record["name"]
+            student_id = record["key"].split('_attempt_')[0]  # Extract ID from filename
+            full_submission_paths = record["submission_paths"]
+            submission_filenames = [os.path.basename(path) for path in full_submission_paths]
             
             if not submission_filenames:
                 print(f"No valid submission files found for student {student_id}")
                 continue
                 
-            print(f"Processing submission {processed_count+1}/{min(test_limit or len(txt_files), len(txt_files))}: {student_id} - {student_name}")
+            print(f"Processing submission {processed_count+1}/{min(test_limit or len(gradebook_index), len(gradebook_index))}: {student_id} - {student_name}")
             print(f"Found {len(submission_filenames)} PDF files for this student")
             
-            # Process all PDF files for this student
-            all_student_images = []
+            # Check if we already graded exactly these files with the current prompt, references and model
+            cache_key = grading_cache_key(full_submission_paths)
+            cached_result = load_cached_result(cache_key)
+            if cached_result is not None:
+                print(f"Student {student_id} already processed, loading from cache")
+                run_metrics.count("result_cache_hits")
+                save_grading_result(submission_filenames[0], cached_result, cache_key)
+                all_results[submission_filenames[0]] = cached_result
+                if job_queue is not None:
+                    job_queue.complete(record["key"])
+                processed_count += 1
+                continue
             
-            for idx, (submission_filename, full_submission_path) in enumerate(zip(submission_filenames, full_submission_paths)):
-                print(f"Processing file {idx+1}/{len(submission_filenames)}: {submission_filename}")
-                
-                # Check if we already processed this student's submission
-                result_path = os.path.join(output_dir, f"{submission_filename}_grading.json")
-                if os.path.exists(result_path) and idx == 0:  # Only check for first file to avoid duplicate processing
-                    print(f"Student {student_id} already processed, loading from file")
-                    with open(result_path, 'r') as f:
-                        all_results[submission_filenames[0]] = json.load(f)
-                    processed_count += 1
-                    break
-                
-                # Convert student submission to images and add to collection
-                file_ext = full_submission_path.lower().split('.')[-1] if '.' in full_submission_path else ''
-                if file_ext == 'pdf':
-                    student_file_images = pdf_to_images(full_submission_path, dpi=100)
-                    student_file_images = [compress_image(img) for img in student_file_images]
-                    all_student_images.extend(student_file_images)
-                    print(f"Added {len(student_file_images)} pages from PDF file {submission_filename}")
-                elif file_ext in ['jpg', 'jpeg', 'png']:
-                    try:
-                        img = Image.open(full_submission_path)
-                        img = compress_image(img)
-                        all_student_images.append(img)
-                        print(f"Added image file {submission_filename}")
-                    except Exception as e:
-                        print(f"Error loading image file {submission_filename}: {str(e)}")
+            # Use the first filename as the identifier
+            submission_identifier = submission_filenames[0]
             
-            # Skip if we already processed this student (continue the outer loop)
-            if submission_filenames[0] in all_results:
+            # Another student with exactly the same files is graded once for both
+            leader = submission_groups.claim(submission_identifier, cache_key) if group_duplicate_submissions else None
+            if leader is not None:
+                print(f"Student {student_id} submitted the same files as {leader}; sharing its grade")
+                all_results[submission_identifier] = executor.submit(share_duplicate_result, submission_identifier, leader, cache_key,
+                                                                     full_submission_paths, reference_images, page_budget, prefetch_pool)
+                if job_queue is not None:
+                    all_results[submission_identifier].add_done_callback(functools.partial(finish_job, job_queue, record["key"]))
+                processed_count += 1
                 continue
-                
-            # Add delay between submissions to avoid rate limits
-            if processed_count > 0:
-                delay = random.uniform(15, 30)  # Random delay between 15-30 seconds
-                print(f"Waiting {delay:.2f} seconds before processing next submission...")
-                time.sleep(delay)
             
-            # Create a temporary full submission path for processing
-            if all_student_images:
-                # Process all images from all files as one submission
-                print(f"Processing all {len(all_student_images)} pages from {len(submission_filenames)} files")
-                
-                # Use the first filename as the identifier
-                submission_identifier = submission_filenames[0]
-                
-                # Custom process_submission function that accepts images directly
-                result = process_submission_with_images(all_student_images, submission_identifier, reference_images)
-                all_results[submission_identifier] = result
+            if batch:
+                # Batch mode: prepare pages in the background, prefetch_depth students ahead, and add each student to the
+                # current batch once their pages are in; full batches go out right away, so memory holds at most one batch
+                prepare_future = prefetch_pool.submit(prepare_student_pages, full_submission_paths, known_file_digests(full_submission_paths), page_budget)
+                batch_pending.append((submission_identifier, cache_key, prepare_future))
+                batch_identifiers.append(submission_identifier)
+                all_results[submission_identifier] = None
+                while len(batch_pending) > prefetch_depth:
+                    pending_identifier, pending_cache_key, pending_future = batch_pending.popleft()
+                    batch_prepared_submission(batches, pending_future, pending_identifier, reference_images, pending_cache_key)
             else:
-                print(f"No valid images found in submission files for student {student_id}")
-                continue
+                # Wait for a free slot (backpressure), then queue the student on both stages
+                payload_slots.acquire()
+                try:
+                    prepare_future = prefetch_pool.submit(prepare_student_pages, full_submission_paths, known_file_digests(full_submission_paths), page_budget)
+                    all_results[submission_identifier] = executor.submit(grade_prepared_submission, prepare_future, submission_identifier, reference_images, cache_key, payload_slots)
+                    if job_queue is not None:
+                        all_results[submission_identifier].add_done_callback(functools.partial(finish_job, job_queue, record["key"]))
+                except Exception:
+                    payload_slots.release()
+                    raise
             
             processed_count += 1
             if test_limit is not None and processed_count >= test_limit:
@@ -506,196 +2609,255 @@ def main():
                 break
                 
         except Exception as e:
-            print(f"Error processing text file {txt_file}: {str(e)}")
+            print(f"Error processing text file {record['txt_path']}: {str(e)}")
+            if submission_identifier is not None and submission_identifier not in all_results:
+                # Don't leave byte-identical submissions waiting on one that was never queued
+                submission_groups.finish(submission_identifier, None)
+            if job_queue is not None:
+                job_queue.release(record["key"], str(e))
             continue
     
-    # Create CSV for Blackboard
+    # Wait for the pipeline (or the batches) to finish, then collect results in record order
+    if batch_identifiers:
+        while batch_pending:
+            submission_identifier, cache_key, prepare_future = batch_pending.popleft()
+            batch_prepared_submission(batches, prepare_future, submission_identifier, reference_images, cache_key)
+        batch_results = batches.collect()
+        # Byte-identical submissions waiting in the executor can share these results now
+        for submission_identifier in batch_identifiers:
+            submission_groups.finish(submission_identifier, batch_results.get(submission_identifier))
+        for submission_identifier in batch_identifiers:
+            if submission_identifier in batch_results:
+                all_results[submission_identifier] = batch_results[submission_identifier]
+            else:
+                del all_results[submission_identifier]
+    for submission_identifier, result in list(all_results.items()):
+        if isinstance(result, Future):
+            try:
+                all_results[submission_identifier] = result.result()
+            except Exception as e:
+                print(f"Error processing submission {submission_identifier}: {str(e)}")
+                all_results[submission_identifier] = None
+            if all_results[submission_identifier] is None:
+                # No pages could be prepared for this student
+                del all_results[submission_identifier]
+    
+    return all_results
+
+def grade_assignment(args, prefetch_pool, executor, payload_slots):
+    """Grade the gradebook in student_dir into output_dir on the shared pools; returns the job queue in --worker mode"""
+    global run_metrics, submission_groups, _gradebook_index
+    run_metrics = RunMetrics()
+    submission_groups = SubmissionGroups()
+    
+    # Create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Index all student submission text files in a single pass over the gradebook
+    gradebook_index = build_gradebook_index()
+    _gradebook_index = gradebook_index  # Used to fill in student details when results are recorded
+    
+    if not gradebook_index and not args.watch:
+        print("No student submission metadata files found. Check the directory path.")
+        return None
+        
+    print(f"Found {len(gradebook_index)} student submissions")
+    
+    # Pick up any batches an interrupted --batch run left behind, so they land in the result cache
+    if args.batch:
+        collect_pending_batches()
+    
+    # Prepare reference images once to avoid repetitive processing
+    reference_images = prepare_reference_images()
+    page_budget = page_budget_for(reference_images)
+    if per_problem_grading:
+        reference_images['problems'] = prepare_problem_references(reference_images)
+    
+    # Worker mode: every worker queues the whole gradebook (existing jobs are kept), then grades only what it leases
+    job_queue = None
+    records = gradebook_index.values()
+    if args.worker:
+        job_queue = JobQueue(job_queue_path, f"{socket.gethostname()}:{os.getpid()}")
+        job_queue.enqueue((record["key"], os.path.basename(record["submission_paths"][0]), grading_cache_key(record["submission_paths"]))
+                          for record in gradebook_index.values() if record["submission_paths"])
+        job_queue.start_heartbeat()
+        records = claimed_records(job_queue, gradebook_index, payload_slots)
+    
+    if args.watch:
+        try:
+            watch_gradebook(gradebook_index, reference_images, page_budget, prefetch_pool, executor, payload_slots)
+        except KeyboardInterrupt:
+            print("Stopped watching the gradebook")
+        return None
+    
+    all_results = grade_records(records, gradebook_index, reference_images, page_budget, prefetch_pool, executor, payload_slots,
+                                batch=args.batch, job_queue=job_queue)
+    
+    # Write the run report (per-stage latencies, throughput, tokens)
+    summary = run_metrics.write_reports()
+    print(f"Graded {summary['students_graded']} submissions via the API in {summary['elapsed_seconds']:.1f} seconds "
+          f"({summary['students_per_minute']:.2f}/min, {summary['totals'].get('input_tokens', 0)} input / "
+          f"{summary['totals'].get('output_tokens', 0)} output tokens). Run report: {metrics_json_path}")
+    groups = submission_groups.write_report()
+    if groups:
+        print(f"Found {len(groups)} groups of identical or near-identical submissions. Groups report: {duplicate_groups_path}")
+    
+    # Create CSV for Blackboard (workers export the whole gradebook, including students other workers graded)
+    if job_queue is not None:
+        all_results = dict.fromkeys(gradebook_identifiers(gradebook_index))
     if all_results:
-        csv_path = create_blackboard_csv(all_results)
+        csv_path = create_blackboard_csv(list(all_results))
         if csv_path:
             print(f"Grading complete! Results saved to {csv_path}")
         else:
             print("No CSV file was generated due to processing errors.")
     else:
         print("No results were generated. Please check the inputs and try again.")
+    return job_queue
+
+def main(argv=None):
+    """Main function to process all submissions"""
+    global api_slots, per_problem_grading, upload_reference_files, send_native_pdfs, use_model_cascade, results_db_shared
+    parser = argparse.ArgumentParser(description="Grade homework submissions with Claude")
+    parser.add_argument("--assignments", metavar="SPEC", help="grade every assignment listed in this JSON run spec in one run, sharing the worker pools and page cache")
+    parser.add_argument("--batch", action="store_true", help="grade the whole gradebook through the Message Batches API")
+    parser.add_argument("--per-problem", action="store_true", help="grade each problem in its own request, sending only the pages that show it")
+    parser.add_argument("--cascade", action="store_true", help="grade with screening_model first and regrade only uncertain or partial-credit students with grading_model")
+    parser.add_argument("--native-pdfs", action="store_true", help="send small student PDFs as document blocks instead of rasterizing them")
+    parser.add_argument("--upload-references", action="store_true", help="upload the question and solution PDFs once through the Files API and reference them by file_id")
+    parser.add_argument("--watch", action="store_true", help="keep running and grade new or changed submissions as they appear in student_dir")
+    parser.add_argument("--worker", action="store_true", help="share the gradebook with other --worker processes through the job queue in output_dir")
+    parser.add_argument("--export-csv", action="store_true", help="only write the Blackboard CSV from the results database, without grading")
+    parser.add_argument("--student", action="append", metavar="STUDENT_ID", help="with --export-csv, export only these students (repeatable)")
+    args = parser.parse_args(argv)
+    results_db_shared = args.worker
+    assignments = [None]  # None grades the assignment set up in the module settings
+    if args.assignments:
+        if args.watch:
+            # Watching never finishes one assignment to move on to the next
+            parser.error("--watch can't be combined with --assignments")
+        try:
+            assignments = load_run_spec(args.assignments)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"can't read run spec {args.assignments}: {str(e)}")
+    if args.export_csv:
+        for assignment in assignments:
+            if assignment is not None:
+                configure_assignment(assignment)
+            csv_path = create_blackboard_csv(student_ids=args.student)
+            if csv_path:
+                print(f"Exported results to {csv_path}")
+        return
+    if args.batch and args.per_problem:
+        # Per-problem grading needs the page index back before it can build the problem requests
+        parser.error("--per-problem can't be combined with --batch")
+    if args.cascade and (args.batch or args.per_problem):
+        # Escalation decides on each grade as it arrives, which neither of these modes has a place for
+        parser.error("--cascade can't be combined with --batch or --per-problem")
+    if args.per_problem and args.native_pdfs:
+        # Per-problem requests send a subset of the student's pages, which a whole PDF document can't be split into
+        parser.error("--native-pdfs can't be combined with --per-problem")
+    if args.batch and args.worker:
+        # A batch can take hours; its students would outlive any reasonable lease
+        parser.error("--worker can't be combined with --batch")
+    if args.watch and (args.batch or args.worker):
+        parser.error("--watch can't be combined with --batch or --worker")
+    per_problem_grading = args.per_problem
+    send_native_pdfs = args.native_pdfs
+    use_model_cascade = args.cascade
+    upload_reference_files = args.upload_references
+    
+    # The prefetch workers copy page_cache_dir when they start, so the shared page cache has to be set first
+    if assignments[0] is not None:
+        configure_assignment(assignments[0])
+    
+    # Grading is a two-stage pipeline: a process pool rasterizes and encodes upcoming students while API
+    # threads grade the ones already prepared. payload_slots bounds the students that are being prepared,
+    # waiting, or in flight, so memory stays bounded; api_slots bounds concurrent messages.create calls.
+    # all_results keeps gradebook order by holding a Future for each student until the pipeline drains.
+    # The pools, the API client and its rate limiter are shared by every assignment of a run spec.
+    api_slots = threading.BoundedSemaphore(max(1, max_concurrent_requests))
+    payload_slots = threading.BoundedSemaphore(max(1, max_concurrent_requests) + prefetch_depth)
+    # Workers are spawned rather than forked, since the parent already runs API threads by the time they start
+    prefetch_pool = ProcessPoolExecutor(
+        max_workers=max(1, prefetch_processes),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_prefetch_worker,
+        initargs=({name: globals()[name] for name in _prefetch_setting_names},)
+    )
+    executor = ThreadPoolExecutor(max_workers=max(1, max_concurrent_requests) + prefetch_depth)
+    
+    job_queues = []
+    try:
+        for assignment in assignments:
+            if assignment is not None:
+                configure_assignment(assignment)
+                print(f"Grading {assignment['name']} ({student_dir} -> {output_dir})")
+            job_queue = grade_assignment(args, prefetch_pool, executor, payload_slots)
+            if job_queue is not None:
+                job_queues.append(job_queue)
+    finally:
+        executor.shutdown(wait=True)
+        prefetch_pool.shutdown(wait=True)
+    # Job callbacks run on the API threads, so the queues are closed only once those have finished
+    for job_queue in job_queues:
+        print(f"Job queue {job_queue.path}: {job_queue.counts()}")
+        job_queue.close()
+    
+    # Keep the page cache under its size cap
+    evict_page_cache()
 
-def process_submission_with_images(student_images, student_identifier, reference_images=None):
+def process_submission_with_images(student_images, student_identifier, reference_images=None, cache_key=None, student_documents=()):
     """Process a single student submission with pre-loaded images"""
     print(f"Processing submission for student {student_identifier}...")
+    raw_response = None
+    elapsed_seconds = None
+    model = None
     
     try:
         # If reference images weren't provided, create them now
         if reference_images is None:
             reference_images = prepare_reference_images()
-            
-        question_images = reference_images['question_images']
-        solution_images = reference_images['solution_images']
-        
-        print(f"Processing student submission with {len(student_images)} pages")
-        
-        # Create the grading prompt
-        grading_prompt = """
-        You are an expert teaching assistant grading a Digital Signal Processing (ECE317) homework assignment.
-        
-        I have provided multiple images in the following order:
-        1. First set: The homework questions
-        2. Second set: The solution to the assignment
-        3. Third set: The student's submission
-        
-        This homework has 5 questions, each worth 20 marks (for a total of 100 marks).
-        
-        Please grade this submission carefully, following these specific guidelines:
-        - Award full marks (20) if the answer is perfect and matches the solution
-        - Award partial marks (15-18) if the answer is partially correct or has minor errors
-        - Award 0 marks if the question is not attempted
-        - Be generous with partial credit (prefer to give 18-15 rather than lower scores)
-        
-        For ONLY the questions that did NOT receive full marks (20), provide a single line of 
-        feedback explaining why marks were deducted. The feedback should be very brief and to the point.
-        
-        Format your response as JSON with the following structure:
-        {
-            "problems": [
-                {
-                    "problem_number": 1,
-                    "score": 20,  // Full marks example, no feedback needed
-                    "max_score": 20
-                },
-                {
-                    "problem_number": 2,
-                    "score": 18,  // Partial marks example
-                    "max_score": 20,
-                    "feedback": "Missed the aliasing explanation in the frequency domain."
-                },
-                // Repeat for all 5 questions
-            ],
-            "overall_score": Z,  // Sum of all 5 question scores
-            "overall_max": 100,
-            "overall_feedback": "Brief summary of the student's overall performance"
-        }
-        
-        Return only the JSON with no additional text. Ensure you grade all 5 questions.
-        """
-        
-        # Prepare message content with images
-        message_content = [{"type": "text", "text": grading_prompt}]
         
-        # Add question images
-        for i, img in enumerate(question_images):
-            message_content.append({
-                "type": "text",
-                "text": f"QUESTION PAGE {i+1}:"
-            })
-            message_content.append({
-                "type": "image", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "image/jpeg", 
-                    "data": image_to_base64(img)
-                }
-            })
-            
-        # Add solution images
-        for i, img in enumerate(solution_images):
-            message_content.append({
-                "type": "text",
-                "text": f"SOLUTION PAGE {i+1}:"
-            })
-            message_content.append({
-                "type": "image", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "image/jpeg", 
-                    "data": image_to_base64(img)
-                }
-            })
-        
-        # Add student images
-        message_content.append({
-            "type": "text",
-            "text": "STUDENT SUBMISSION:"
-        })
-        
-        for i, img in enumerate(student_images):
-            message_content.append({
-                "type": "text",
-                "text": f"STUDENT PAGE {i+1}:"
-            })
-            message_content.append({
-                "type": "image", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "image/jpeg", 
-                    "data": image_to_base64(img)
-                }
-            })
-        
-        # Add retry logic with exponential backoff
-        max_retries = 5
-        base_delay = 10  # seconds
+        page_count = len(student_images) + sum(document["pages"] for document in student_documents)
+        print(f"Processing student submission with {page_count} pages")
+        message_content = build_message_content(student_images, reference_images, student_documents)
         
-        for attempt in range(max_retries):
-            try:
-                print(f"API attempt {attempt+1}/{max_retries}...")
-                # Call Claude API
-                response = anthropic_client.messages.create(
-                    model="claude-3-7-sonnet-20250219",
-                    max_tokens=4000,
-                    temperature=0,
-                    system="You are a Digital Signal Processing teaching assistant. Grade homework submissions accurately and fairly, focusing only on the technical content. Format your response as JSON.",
-                    messages=[
-                        {"role": "user", "content": message_content}
-                    ]
-                )
-                
-                # Extract JSON from Claude's response
-                response_text = response.content[0].text
-                # Find JSON in the response (in case Claude adds any text before/after)
-                json_start = response_text.find('{')
-                json_end = response_text.rfind('}') + 1
-                if json_start >= 0 and json_end > json_start:
-                    json_str = response_text[json_start:json_end]
-                    grading_result = json.loads(json_str)
-                    print(f"Successfully processed submission for student {student_identifier}")
-                    # Success! Break out of retry loop
-                    break
-                else:
-                    raise ValueError("No JSON found in the response")
-                    
-            except Exception as e:
-                if "rate_limit_error" in str(e) and attempt < max_retries - 1:
-                    # Rate limit hit, apply exponential backoff
-                    delay = base_delay * (2 ** attempt) + random.uniform(1, 5)
-                    print(f"Rate limit hit. Retrying in {delay:.2f} seconds...")
-                    time.sleep(delay)
-                else:
-                    # Other error or final retry failed
-                    print(f"API error for student {student_identifier}: {str(e)}")
-                    grading_result = {
-                        "problems": [],
-                        "overall_score": 0,
-                        "overall_max": 100,
-                        "overall_feedback": f"API error: {str(e)}",
-                        "error": True
-                    }
-                    break
+        try:
+            # Call Claude API
+            estimated_tokens = reference_images['estimated_tokens'] + estimate_input_tokens(student_images, documents=student_documents)
+            run_metrics.record_student(student_identifier, payload_bytes=payload_bytes(message_content), pages=page_count)
+            started = time.perf_counter()
+            grading_result, raw_response, model = grade_message(message_content, estimated_tokens, student_identifier)
+            elapsed_seconds = time.perf_counter() - started
+            print(f"Successfully processed submission for student {student_identifier}")
                 
+        except Exception as e:
+            # Non-retryable error or final retry failed
+            print(f"API error for student {student_identifier}: {str(e)}")
+            grading_result = {
+                "problems": [],
+                "overall_score": 0,
+                "overall_max": problem_count * problem_max_score,
+                "overall_feedback": f"API error: {str(e)}",
+                "error": True
+            }
+            
     except Exception as e:
         print(f"Processing error for student {student_identifier}: {str(e)}")
         grading_result = {
             "problems": [],
             "overall_score": 0,
-            "overall_max": 100,
+            "overall_max": problem_count * problem_max_score,
             "overall_feedback": f"Processing error: {str(e)}",
             "error": True
         }
     
-    # Save the grading result with a consistent filename
-    # Use the submission filename as identifier, but ensure it doesn't have problematic characters
-    safe_identifier = os.path.basename(student_identifier)
-    result_path = os.path.join(output_dir, f"{safe_identifier}_grading.json")
-    with open(result_path, 'w') as f:
-        json.dump(grading_result, f, indent=2)
+    # Record the result, with the raw response for auditing even when it couldn't be parsed. The result cache goes
+    # first: if the database write fails, the job is retried and picks the paid grade up from the cache
+    if cache_key:
+        save_cached_result(cache_key, grading_result)
+    save_grading_result(student_identifier, grading_result, cache_key, raw_response, elapsed_seconds, model)
     
     return grading_result
 